@@ -0,0 +1,41 @@
+"""Uncached lookups in a registry with thousands of broad registrations.
+
+Like the views of a large web application, thousands of
+implementations are registered for ``object`` and the ``GET`` request
+method, each under its own name. The index sets for ``object`` and
+``GET`` are huge, while the one for a name only has a single value, so
+the order in which :meth:`reg.PredicateRegistry.get` intersects them
+matters.
+
+Run this with reg installed, for instance with ``pip install -e .``.
+"""
+
+import timeit
+
+from reg.predicate import PredicateRegistry, match_instance, match_key
+
+VIEWS = 5000
+
+
+class Document(object):
+    pass
+
+
+registry = PredicateRegistry(
+    match_instance("obj"), match_key("request_method"), match_key("name")
+)
+for i in range(VIEWS):
+    registry.register((object, "GET", "view%d" % i), "view %d" % i)
+    registry.register((Document, "POST", "view%d" % i), "post %d" % i)
+
+
+def timed(name, func, number=1000):
+    elapsed = min(timeit.repeat(func, number=number, repeat=5))
+    print("%-40s %10.2f us" % (name, elapsed / number * 1e6))
+
+
+print("%d registrations" % len(registry.known_keys))
+timed("get", lambda: registry.get((object, "GET", "view17")))
+timed("get, no match", lambda: registry.get((Document, "GET", "view17")))
+timed("all", lambda: list(registry.all((Document, "GET", "view17"))))
+timed("component", lambda: registry.component((Document, "GET", "view17")))
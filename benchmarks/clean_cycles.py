@@ -0,0 +1,76 @@
+"""Per-call time of dispatch functions cleaned over and over.
+
+Test suites clean dispatch functions between tests, then register
+implementations again. This replays such a workload: each cycle
+cleans the dispatch functions, registers implementations and calls
+them. The interpreter of Python 3.11 and later specializes the byte
+code of functions called often, so how fast calls are depends on
+whether cleaning invalidates that.
+
+Run this with reg installed, for instance with ``pip install -e .``.
+"""
+
+import sys
+import time
+
+from reg import dispatch, match_instance, match_key, DictCachingKeyLookup
+
+CYCLES = 200
+CALLS = 2000
+
+
+class Model(object):
+    pass
+
+
+class Document(Model):
+    pass
+
+
+@dispatch(match_instance("obj"), get_key_lookup=DictCachingKeyLookup)
+def title(obj):
+    return "untitled"
+
+
+@dispatch(
+    match_instance("obj"),
+    match_key("name"),
+    get_key_lookup=DictCachingKeyLookup,
+)
+def view(obj, name):
+    return "default"
+
+
+def document_title(obj):
+    return "document"
+
+
+def edit_view(obj, name):
+    return "edit"
+
+
+def cycle():
+    title.clean()
+    view.clean()
+    title.register(document_title, obj=Document)
+    view.register(edit_view, obj=Model, name="edit")
+    doc = Document()
+    start = time.perf_counter()
+    for _ in range(CALLS):
+        title(doc)
+        view(doc, "edit")
+    return time.perf_counter() - start
+
+
+timings = [cycle() for _ in range(CYCLES)]
+late = sorted(timings[CYCLES // 2 :])[: CYCLES // 4]
+
+print(
+    "Python %d.%d: %.3f us per call after %d clean() cycles"
+    % (
+        sys.version_info[0],
+        sys.version_info[1],
+        sum(late) / len(late) / (2 * CALLS) * 1e6,
+        CYCLES,
+    )
+)
@@ -0,0 +1,49 @@
+"""Effect of the default key lookup on the test suite.
+
+Runs the test suite with each ``REG_KEY_LOOKUP`` specification, and
+reports the best wall clock time over a few runs, relative to running
+it without caching. Dispatch functions in the test suite mostly don't
+specify a key lookup, so they use the default.
+"""
+
+import os
+import subprocess
+import sys
+import time
+
+SPECS = ["identity", "dict", "lru:5000", "adaptive"]
+RUNS = 5
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_tests(spec):
+    env = dict(os.environ, REG_KEY_LOOKUP=spec)
+    command = [sys.executable, "-m", "pytest", "-q", "-p", "no:cacheprovider"]
+    best = None
+    for i in range(RUNS):
+        start = time.perf_counter()
+        result = subprocess.run(
+            command + [os.path.join(root, "reg")],
+            env=env,
+            cwd=root,
+            stdout=subprocess.DEVNULL,
+        )
+        duration = time.perf_counter() - start
+        if result.returncode:
+            # the timings of a failing suite don't mean anything
+            sys.exit("The tests fail with REG_KEY_LOOKUP=%s" % spec)
+        best = duration if best is None else min(best, duration)
+    return best
+
+
+# warm up disk caches and bytecode first
+run_tests(SPECS[0])
+base = run_tests(SPECS[0])
+
+print("\nDefault key lookup")
+print("==================")
+
+for spec in SPECS:
+    duration = base if spec == SPECS[0] else run_tests(spec)
+    print("{0:<10} {1:.3f}s {2:.2f}x".format(spec, duration, duration / base))
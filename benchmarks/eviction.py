@@ -0,0 +1,106 @@
+"""Hit rates of the cache eviction policies on replayed traces.
+
+Each trace is a sequence of keys, replayed through each cache. The
+skewed trace follows a Zipf distribution, as dispatch keys of a web
+application tend to. The scan trace is the skewed trace interrupted
+by a batch job that goes through many keys once; its hit rate is
+measured on the skewed accesses right after the scan, while the
+cache recovers from it.
+
+Run this with reg installed, for instance with ``pip install -e .``.
+"""
+
+import random
+import time
+
+from repoze.lru import LRUCache
+
+from reg.cache import (
+    Cache,
+    GenerationalCache,
+    LruCache,
+    TwoQueueCache,
+    ArcCache,
+)
+
+KEYS = 10000
+SIZE = 500
+ACCESSES = 200000
+
+rng = random.Random(0)
+weights = [1 / (rank**1.1) for rank in range(1, KEYS + 1)]
+
+
+def skewed(n):
+    return rng.choices(range(KEYS), weights, k=n)
+
+
+def repoze_lru(func, size):
+    cache = LRUCache(size)
+    marker = object()
+
+    def get(key):
+        result = cache.get(key, marker)
+        if result is marker:
+            result = func(key)
+            cache.put(key, result)
+        return result
+
+    return get
+
+
+def dict_cache(func, size):
+    return Cache(func).__getitem__
+
+
+def policy(cls):
+    return lambda func, size: cls(func, size).__getitem__
+
+
+CACHES = [
+    ("dict (unbounded)", dict_cache),
+    ("repoze.lru", repoze_lru),
+    ("lru", policy(LruCache)),
+    ("2q", policy(TwoQueueCache)),
+    ("arc", policy(ArcCache)),
+    ("adaptive", policy(GenerationalCache)),
+]
+
+before = skewed(ACCESSES // 2)
+after = skewed(ACCESSES // 2)
+scan = list(range(KEYS, KEYS + 4 * SIZE))
+
+TRACES = [
+    ("skewed", [], before + after),
+    ("scan", before + scan, after[: 4 * SIZE]),
+]
+
+
+def replay(make_cache, warmup, trace):
+    misses = [0]
+
+    def func(key):
+        misses[0] += 1
+        return key
+
+    get = make_cache(func, SIZE)
+    for key in warmup:
+        get(key)
+    misses[0] = 0
+    start = time.perf_counter()
+    for key in trace:
+        get(key)
+    duration = time.perf_counter() - start
+    return 1 - misses[0] / len(trace), duration / len(trace)
+
+
+for trace_name, warmup, trace in TRACES:
+    print("\n{} trace, cache size {}".format(trace_name, SIZE))
+    print("=" * 40)
+    for cache_name, make_cache in CACHES:
+        hit_rate, duration = replay(make_cache, warmup, trace)
+        print(
+            "{0:<18} {1:6.2%} hits {2:6.0f} ns/access".format(
+                cache_name, hit_rate, duration * 1e9
+            )
+        )
@@ -0,0 +1,50 @@
+"""Per-call time of dispatch functions by call site polymorphism.
+
+Dispatch functions remember the implementations of their last two
+keys. This times calls that always dispatch on the same class
+(monomorphic), alternate between two (bimorphic), or go through many
+(megamorphic), with a dictionary caching key lookup.
+
+Run this with reg installed, for instance with ``pip install -e .``.
+"""
+
+import sys
+import timeit
+
+from reg import dispatch, match_instance, match_key, DictCachingKeyLookup
+
+CLASSES = 8
+CALLS = 200000
+
+classes = [type("Model{}".format(i), (object,), {}) for i in range(CLASSES)]
+
+
+@dispatch(
+    match_instance("obj"),
+    match_key("name"),
+    get_key_lookup=DictCachingKeyLookup,
+)
+def view(obj, name):
+    return "default"
+
+
+for cls in classes:
+    view.register(lambda obj, name: "view", obj=cls, name="edit")
+
+instances = [cls() for cls in classes]
+patterns = {
+    "monomorphic": [instances[0]],
+    "bimorphic": instances[:2],
+    "megamorphic": instances,
+}
+
+print("Python %d.%d" % sys.version_info[:2])
+for name, objs in patterns.items():
+    calls = (objs * (CALLS // len(objs)))[:CALLS]
+
+    def run():
+        for obj in calls:
+            view(obj, "edit")
+
+    elapsed = min(timeit.repeat(run, number=1, repeat=5))
+    print("%-12s %.3f us per call" % (name, elapsed / CALLS * 1e6))
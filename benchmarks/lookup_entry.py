@@ -0,0 +1,78 @@
+"""Access to the lookup entries returned by ``by_args``.
+
+Like a web framework looking up a view, this reads the component and
+the fallback of a :class:`reg.LookupEntry` a few times, once with a
+dictionary caching key lookup and once without caching. It also times
+getting entries with ``by_args`` and ``by_predicates``, as a router
+does for each request.
+
+Run this with reg installed, for instance with ``pip install -e .``.
+"""
+
+import timeit
+
+from reg import dispatch, match_instance, match_key, DictCachingKeyLookup
+
+
+class Document(object):
+    pass
+
+
+class Report(Document):
+    pass
+
+
+def view_function(get_key_lookup):
+    @dispatch(
+        match_instance("obj"),
+        match_key("name"),
+        match_key("request_method"),
+        get_key_lookup=get_key_lookup,
+    )
+    def view(obj, name, request_method):
+        return "default"
+
+    view.register(
+        lambda obj, name, request_method: "view",
+        obj=Document,
+        name="edit",
+        request_method="GET",
+    )
+    return view
+
+
+def view_lookup(view, obj):
+    entry = view.by_args(obj, "edit", "GET")
+    if entry.component is not None:
+        return entry.component
+    if entry.fallback is not None:
+        return entry.fallback
+    return entry.component
+
+
+def timed(name, func, number=100000):
+    elapsed = min(timeit.repeat(func, number=number, repeat=5))
+    print("%-40s %10.2f us" % (name, elapsed / number * 1e6))
+
+
+report = Report()
+for caching, get_key_lookup in [
+    ("cached", DictCachingKeyLookup),
+    ("uncached", None),
+]:
+    view = view_function(get_key_lookup)
+    timed(
+        "by_args().component, %s" % caching,
+        lambda: view.by_args(report, "edit", "GET").component,
+    )
+    timed(
+        "by_predicates().component, %s" % caching,
+        lambda: view.by_predicates(
+            obj=Report, name="edit", request_method="GET"
+        ).component,
+    )
+    timed("view lookup, %s" % caching, lambda: view_lookup(view, report))
+    timed(
+        "view lookup, no match, %s" % caching,
+        lambda: view_lookup(view, 1),
+    )
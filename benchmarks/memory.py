@@ -0,0 +1,71 @@
+"""Memory used by the indexes of a registry with many registrations.
+
+Like the views of a large web application, each of the registrations
+is for a name of its own, while they share the class and the request
+method. Most keys of the indexes then have a single value. In another
+registry, a few views are registered for many classes, so that many
+keys of the indexes have the same values. This measures the memory
+allocated to fill the registries with ``tracemalloc``, and times
+lookups.
+
+Run this with reg installed, for instance with ``pip install -e .``.
+"""
+
+import timeit
+import tracemalloc
+
+from reg.predicate import PredicateRegistry, match_instance, match_key
+
+REGISTRATIONS = 100000
+SHARED_VIEWS = 5
+
+
+class Document(object):
+    pass
+
+
+# the keys and values exist anyway, so they aren't measured
+names = ["view%d" % i for i in range(REGISTRATIONS)]
+models = [
+    type("Model%d" % i, (object,), {})
+    for i in range(REGISTRATIONS // SHARED_VIEWS)
+]
+views = [((Document, "GET", name), name) for name in names]
+shared_views = [
+    ((model, "GET", name), name)
+    for model in models
+    for name in names[:SHARED_VIEWS]
+]
+
+
+def fill(registrations):
+    registry = PredicateRegistry(
+        match_instance("obj"), match_key("request_method"), match_key("name")
+    )
+    for key, value in registrations:
+        registry.register(key, value)
+    return registry
+
+
+def measured(name, registrations):
+    tracemalloc.start()
+    registry = fill(registrations)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("%-40s %10.1f MB" % (name, size / 1e6))
+    return registry
+
+
+print("%d registrations" % REGISTRATIONS)
+registry = measured("registry", views)
+measured("registry, shared views", shared_views)
+
+
+def timed(name, func, number=100000):
+    elapsed = min(timeit.repeat(func, number=number, repeat=5))
+    print("%-40s %10.2f us" % (name, elapsed / number * 1e6))
+
+
+timed("get", lambda: registry.get((Document, "GET", "view17")))
+timed("get, no match", lambda: registry.get((Document, "POST", "view17")))
+timed("fallback", lambda: registry.fallback((Document, "POST", "view17")))
@@ -0,0 +1,79 @@
+"""Uncached lookups in a sparse predicate registry.
+
+The registry has four class predicates and deep class hierarchies, so
+the permutations of a key number in the tens of thousands, while only
+a few dozen of them have registrations. Another registry only has
+matches late in the order of the permutations. Lookups go straight to the
+:class:`reg.PredicateRegistry`, as they do without a caching key
+lookup or on a cache miss.
+
+Run this with reg installed, for instance with ``pip install -e .``.
+"""
+
+import timeit
+
+from reg.predicate import PredicateRegistry, match_instance
+
+DEPTH = 12
+PREDICATES = 4
+
+
+def hierarchy(name):
+    classes = [object]
+    for i in range(DEPTH):
+        classes.append(type("%s%d" % (name, i), (classes[-1],), {}))
+    return classes
+
+
+hierarchies = [hierarchy(name) for name in "ABCD"[:PREDICATES]]
+registry = PredicateRegistry(
+    *[match_instance(name) for name in "abcd"[:PREDICATES]]
+)
+# a few dozen registrations, on every third level of each hierarchy
+for i in range(1, DEPTH, 3):
+    for j in range(1, DEPTH, 3):
+        for k in (1, DEPTH // 2):
+            key = (
+                hierarchies[0][i],
+                hierarchies[1][j],
+                hierarchies[2][k],
+                hierarchies[3][1],
+            )
+            registry.register(key, key)
+
+# registrations that only match late in the order of the permutations:
+# the first and second predicates of each are far apart
+late_registry = PredicateRegistry(
+    *[match_instance(name) for name in "abcd"[:PREDICATES]]
+)
+for i in range(1, DEPTH // 2):
+    for k in range(1, DEPTH, 2):
+        for m in range(1, DEPTH, 2):
+            key = (
+                hierarchies[0][i],
+                hierarchies[1][DEPTH - i],
+                hierarchies[2][k],
+                hierarchies[3][m],
+            )
+            late_registry.register(key, key)
+
+deepest = tuple(classes[-1] for classes in hierarchies)
+unmatched = deepest[:-1] + (object,)
+
+
+def timed(name, func, number=1000):
+    elapsed = min(timeit.repeat(func, number=number, repeat=5))
+    print("%-40s %10.2f us" % (name, elapsed / number * 1e6))
+
+
+print(
+    "%d registrations, %d permutations"
+    % (len(registry.known_keys), len(list(registry.permutations(deepest))))
+)
+timed("all, deepest key", lambda: list(registry.all(deepest)))
+timed("component, deepest key", lambda: registry.component(deepest))
+timed("first of all, deepest key", lambda: next(registry.all(deepest)))
+timed("component, unmatched key", lambda: registry.component(unmatched))
+timed("component, late match", lambda: late_registry.component(deepest))
+timed("first of all, late match", lambda: next(late_registry.all(deepest)))
+timed("fallback, unmatched key", lambda: registry.fallback(unmatched))
@@ -1,5 +1,5 @@
 # flake8: noqa
-from .dispatch import dispatch, Dispatch, LookupEntry
+from .dispatch import dispatch, Dispatch, LookupEntry, set_default_key_lookup
 from .context import (
     dispatch_method,
     DispatchMethod,
@@ -16,4 +16,27 @@ from .predicate import (
     match_instance,
     match_class,
 )
-from .cache import DictCachingKeyLookup, LruCachingKeyLookup
+from .cache import (
+    DictCachingKeyLookup,
+    LruCachingKeyLookup,
+    PolicyCachingKeyLookup,
+    AdaptiveCachingKeyLookup,
+    key_lookup_from_spec,
+    set_cache_budget,
+    cache_budget,
+)
+from .instrument import (
+    enable_metrics,
+    disable_metrics,
+    metrics,
+    reset_metrics,
+    enable_key_histograms,
+    disable_key_histograms,
+    KeyHistogram,
+    enable_slow_lookups,
+    disable_slow_lookups,
+    slow_lookups,
+    clear_slow_lookups,
+    SlowLookup,
+)
+from .warmup import key_profile, save_key_profile, load_key_profile
@@ -1,3 +1,7 @@
+import os
+import warnings
+import weakref
+from collections import OrderedDict
 from repoze.lru import lru_cache
 
 
@@ -12,7 +16,654 @@ class Cache(dict):
         return result
 
 
-class DictCachingKeyLookup(object):
+_marker = object()
+
+
+class GenerationalCache(Cache):
+    """A dict to cache a function that becomes bounded once it needs to.
+
+    It starts off as a plain :class:`Cache`, growing without bounds,
+    with cache hits that are plain dictionary lookups. Once it holds
+    ``size`` entries, or once too many lookups miss, it becomes bounded
+    and approximates a LRU cache holding at most twice ``size``
+    entries: new entries go to a young generation, which becomes the
+    old generation once it holds ``size`` entries, dropping the
+    previous one. Entries of the old generation that are used again
+    move back to the young one. Starting a new generation only swaps
+    references, so a miss never copies the cache.
+
+    To estimate the miss rate, one in :attr:`SAMPLE` new keys is kept
+    out of the dictionary, so that its lookups can be counted.
+
+    :param func: the function to cache.
+    :param size: the number of entries at which to become bounded, and
+      the number of entries of a generation.
+    :param max_miss_rate: the fraction of lookups missing the cache at
+      which to become bounded, estimated over :attr:`WINDOW` lookups
+      of sampled keys.
+    """
+
+    #: One in this many new keys is sampled to estimate the miss rate.
+    SAMPLE = 16
+    #: The number of lookups of sampled keys per estimate.
+    WINDOW = 100
+
+    def __init__(self, func, size, max_miss_rate=0.5):
+        self.func = func
+        self.size = size
+        self.max_miss_rate = max_miss_rate
+        self.bounded = False
+        self.new_keys = 0
+        self.sampled = {}
+        self.sampled_hits = self.sampled_misses = 0
+        self.young = {}
+        self.old = {}
+
+    def __missing__(self, key):
+        if self.bounded:
+            return self.generation_lookup(key)
+        result = self.sampled.get(key, _marker)
+        if result is not _marker:
+            self.sampled_hits += 1
+            self.estimate()
+            return result
+        result = self.func(key)
+        self.new_keys += 1
+        if self.new_keys % self.SAMPLE:
+            self[key] = result
+        else:
+            self.sampled[key] = result
+            self.sampled_misses += 1
+        if len(self) + len(self.sampled) >= self.size:
+            self.bound()
+        else:
+            self.estimate()
+        return result
+
+    def estimate(self):
+        """Become bounded if too many of the sampled lookups missed."""
+        lookups = self.sampled_hits + self.sampled_misses
+        if lookups < self.WINDOW:
+            return
+        if self.sampled_misses > self.max_miss_rate * lookups:
+            self.bound()
+            return
+        # The sampled keys become plain entries, and new keys are
+        # sampled for the next estimate.
+        self.update(self.sampled)
+        self.sampled = {}
+        self.sampled_hits = self.sampled_misses = 0
+
+    def bound(self):
+        """Start keeping entries in generations."""
+        # The entries so far stay in the dictionary as the first old
+        # generation, which is dropped when the next one starts.
+        self.bounded = True
+        self.young = self.sampled
+        self.sampled = {}
+
+    def generation_lookup(self, key):
+        """Look up a key once the cache is bounded."""
+        young = self.young
+        result = young.get(key, _marker)
+        if result is not _marker:
+            return result
+        result = self.old.pop(key, _marker)
+        if result is _marker:
+            result = self.func(key)
+        if len(young) >= self.size:
+            dict.clear(self)
+            self.old = young
+            self.young = young = {}
+        young[key] = result
+        return result
+
+    def cached_keys(self):
+        """The keys of the cached entries."""
+        return (
+            list(self) + list(self.sampled) + list(self.young) + list(self.old)
+        )
+
+    def clear(self):
+        """Remove all entries.
+
+        A cache that became bounded stays so.
+        """
+        dict.clear(self)
+        self.sampled = {}
+        self.sampled_hits = self.sampled_misses = 0
+        self.young = {}
+        self.old = {}
+
+
+class PolicyCache(object):
+    """Base class of caches of a function with an eviction policy.
+
+    Subclasses look up entries with ``__getitem__``, calling
+    :meth:`compute` for missing ones, and implement :meth:`resize`.
+
+    :param func: the function to cache.
+    :param size: the maximum number of entries.
+    """
+
+    budget = None
+
+    def __init__(self, func, size):
+        self.func = func
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+
+    def compute(self, key):
+        """Compute a missing entry."""
+        self.misses += 1
+        if self.budget is not None:
+            self.budget.miss()
+        return self.func(key)
+
+    def resize(self, size):
+        """Change the maximum number of entries, evicting as needed."""
+        raise NotImplementedError()  # pragma: no cover
+
+    def keys(self):
+        """The keys of the cached entries."""
+        raise NotImplementedError()  # pragma: no cover
+
+    def clear(self):
+        """Remove all entries."""
+        raise NotImplementedError()  # pragma: no cover
+
+
+class LruCache(PolicyCache):
+    """A LRU cache of a function.
+
+    Keeps the ``size`` most recently used entries.
+
+    :param func: the function to cache.
+    :param size: the maximum number of entries.
+    """
+
+    def __init__(self, func, size):
+        super(LruCache, self).__init__(func, size)
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __getitem__(self, key):
+        entries = self.entries
+        result = entries.get(key, _marker)
+        if result is not _marker:
+            self.hits += 1
+            entries.move_to_end(key)
+            return result
+        entries[key] = result = self.compute(key)
+        if len(entries) > self.size:
+            entries.popitem(last=False)
+        return result
+
+    def resize(self, size):
+        self.size = size
+        while len(self.entries) > size:
+            self.entries.popitem(last=False)
+
+    def keys(self):
+        return list(self.entries)
+
+    def clear(self):
+        self.entries.clear()
+
+
+class TwoQueueCache(PolicyCache):
+    """A 2Q cache of a function.
+
+    New entries go to a small FIFO queue first, and only make it to
+    the main LRU queue if they are used again after they were evicted
+    from it, which is remembered for a while. A scan through many keys
+    that are used only once therefore doesn't evict the entries that
+    are used frequently.
+
+    See "2Q: A Low Overhead High Performance Buffer Management
+    Replacement Algorithm", by Theodore Johnson and Dennis Shasha.
+
+    :param func: the function to cache.
+    :param size: the maximum number of entries, at least 1: it always
+      keeps the entry it just computed.
+    """
+
+    def __init__(self, func, size):
+        super(TwoQueueCache, self).__init__(func, max(size, 1))
+        size = self.size
+        self.in_size = max(size // 4, 1)
+        self.out_size = max(size // 2, 1)
+        self.recent = OrderedDict()
+        self.evicted = OrderedDict()
+        self.frequent = OrderedDict()
+
+    def __len__(self):
+        return len(self.recent) + len(self.frequent)
+
+    def __contains__(self, key):
+        return key in self.frequent or key in self.recent
+
+    def __getitem__(self, key):
+        frequent = self.frequent
+        result = frequent.get(key, _marker)
+        if result is not _marker:
+            self.hits += 1
+            frequent.move_to_end(key)
+            return result
+        result = self.recent.get(key, _marker)
+        if result is not _marker:
+            self.hits += 1
+            return result
+        result = self.compute(key)
+        evicted = self.evicted.pop(key, _marker) is not _marker
+        self.reclaim()
+        if evicted:
+            frequent[key] = result
+        else:
+            self.recent[key] = result
+        return result
+
+    def reclaim(self):
+        if len(self) < self.size:
+            return
+        if len(self.recent) > self.in_size or not self.frequent:
+            key, value = self.recent.popitem(last=False)
+            self.evicted[key] = None
+            if len(self.evicted) > self.out_size:
+                self.evicted.popitem(last=False)
+        else:
+            self.frequent.popitem(last=False)
+
+    def resize(self, size):
+        self.size = size = max(size, 1)
+        self.in_size = max(size // 4, 1)
+        self.out_size = max(size // 2, 1)
+        while len(self) > size:
+            self.reclaim()
+        while len(self.evicted) > self.out_size:
+            self.evicted.popitem(last=False)
+
+    def keys(self):
+        return list(self.frequent) + list(self.recent)
+
+    def clear(self):
+        self.recent.clear()
+        self.evicted.clear()
+        self.frequent.clear()
+
+
+class ArcCache(PolicyCache):
+    """An ARC cache of a function.
+
+    The Adaptive Replacement Cache keeps entries used once and entries
+    used more than once in separate LRU lists, and remembers keys
+    recently evicted from either. It uses this to continuously adapt how
+    much of the cache is given to each list. A scan through many keys
+    that are used only once doesn't evict the entries that are used
+    frequently.
+
+    See "ARC: A Self-Tuning, Low Overhead Replacement Cache", by Nimrod
+    Megiddo and Dharmendra S. Modha.
+
+    :param func: the function to cache.
+    :param size: the maximum number of entries, at least 1: it always
+      keeps the entry it just computed.
+    """
+
+    def __init__(self, func, size):
+        super(ArcCache, self).__init__(func, max(size, 1))
+        self.target = 0
+        self.recent = OrderedDict()
+        self.frequent = OrderedDict()
+        self.recent_evicted = OrderedDict()
+        self.frequent_evicted = OrderedDict()
+
+    def __len__(self):
+        return len(self.recent) + len(self.frequent)
+
+    def __contains__(self, key):
+        return key in self.frequent or key in self.recent
+
+    def __getitem__(self, key):
+        frequent = self.frequent
+        result = frequent.get(key, _marker)
+        if result is not _marker:
+            self.hits += 1
+            frequent.move_to_end(key)
+            return result
+        result = self.recent.pop(key, _marker)
+        if result is not _marker:
+            self.hits += 1
+            frequent[key] = result
+            return result
+        result = self.compute(key)
+        recent_evicted = self.recent_evicted
+        frequent_evicted = self.frequent_evicted
+        if key in recent_evicted:
+            self.target = min(
+                self.size,
+                self.target
+                + max(len(frequent_evicted) // len(recent_evicted), 1),
+            )
+            self.replace(False)
+            del recent_evicted[key]
+            frequent[key] = result
+            return result
+        if key in frequent_evicted:
+            self.target = max(
+                0,
+                self.target
+                - max(len(recent_evicted) // len(frequent_evicted), 1),
+            )
+            self.replace(True)
+            del frequent_evicted[key]
+            frequent[key] = result
+            return result
+        recent_size = len(self.recent) + len(recent_evicted)
+        if recent_size == self.size:
+            if len(self.recent) < self.size:
+                recent_evicted.popitem(last=False)
+                self.replace(False)
+            else:
+                self.recent.popitem(last=False)
+        elif recent_size < self.size:
+            total = recent_size + len(frequent) + len(frequent_evicted)
+            if total >= self.size:
+                if total == 2 * self.size:
+                    frequent_evicted.popitem(last=False)
+                self.replace(False)
+        self.recent[key] = result
+        return result
+
+    def replace(self, frequently_evicted):
+        recent = self.recent
+        if recent and (
+            len(recent) > self.target
+            or (frequently_evicted and len(recent) == self.target)
+        ):
+            key, value = recent.popitem(last=False)
+            self.recent_evicted[key] = None
+        elif self.frequent:
+            key, value = self.frequent.popitem(last=False)
+            self.frequent_evicted[key] = None
+
+    def resize(self, size):
+        self.size = size = max(size, 1)
+        self.target = min(self.target, size)
+        while len(self) > size:
+            self.replace(False)
+        while len(self.recent) + len(self.recent_evicted) > size:
+            self.recent_evicted.popitem(last=False)
+        while (
+            len(self) + len(self.recent_evicted) + len(self.frequent_evicted)
+            > 2 * size
+            and self.frequent_evicted
+        ):
+            self.frequent_evicted.popitem(last=False)
+
+    def keys(self):
+        return list(self.frequent) + list(self.recent)
+
+    def clear(self):
+        self.target = 0
+        self.recent.clear()
+        self.frequent.clear()
+        self.recent_evicted.clear()
+        self.frequent_evicted.clear()
+
+
+POLICIES = {"lru": LruCache, "2q": TwoQueueCache, "arc": ArcCache}
+
+
+class CacheBudget(object):
+    """A budget of cache entries shared by caches.
+
+    The caches that are added to the budget are periodically resized
+    to share the budget according to their hit rate: caches with more
+    hits per entry get more entries, but no cache gets more than twice
+    what it currently uses, and every cache gets at least ``min_size``
+    entries, unless the budget is too small for that. Caches of a
+    fixed size can be counted against the budget too, leaving the
+    other caches to share what is left.
+
+    :param entries: the total number of cache entries.
+    :param bytes: the total size of the caches in bytes, as an
+      alternative to ``entries``. This is turned into a number of
+      entries using an estimate of :attr:`ENTRY_BYTES` bytes per
+      entry.
+    :param min_size: the minimum number of entries of each cache.
+    :param interval: the number of cache misses, summed over all
+      caches, between the resizing of the caches.
+    """
+
+    #: Estimated size in bytes of a cache entry, including its key.
+    ENTRY_BYTES = 200
+
+    def __init__(self, entries=None, bytes=None, min_size=16, interval=1000):
+        if (entries is None) == (bytes is None):
+            raise ValueError("Specify either entries or bytes")
+        if entries is None:
+            entries = bytes // self.ENTRY_BYTES
+        self.entries = entries
+        self.min_size = min_size
+        self.interval = interval
+        self.countdown = interval
+        self.caches = weakref.WeakSet()
+        self.reserved = weakref.WeakKeyDictionary()
+        # The entries given to the caches and reserved by caches of a
+        # fixed size. Caches are dropped from the budget when they are
+        # garbage collected, so these are recomputed when rebalancing.
+        self.allocated = 0
+        self.reserved_entries = 0
+
+    def minimum(self, available, count):
+        """The size each of ``count`` caches gets at least."""
+        return max(min(self.min_size, available // (count or 1)), 1)
+
+    def add(self, cache):
+        """Add a cache to share the budget with.
+
+        The cache is removed from the budget when it is garbage
+        collected.
+
+        :param cache: a :class:`reg.cache.PolicyCache`.
+        """
+        cache.budget = self
+        self.caches.add(cache)
+        count = len(self.caches)
+        available = self.entries - self.reserved_entries
+        minimum = self.minimum(available, count)
+        size = min(max(minimum, available // count), available - self.allocated)
+        if size < minimum:
+            # The budget is used up: share it again on the next miss.
+            self.countdown = 1
+        size = max(size, 1)
+        self.allocated += size
+        cache.resize(size)
+
+    def reserve(self, cache, size):
+        """Count a cache of a fixed size against the budget.
+
+        The cache is removed from the budget when it is garbage
+        collected.
+
+        :param cache: the cache.
+        :param size: its maximum number of entries.
+        """
+        self.reserved[cache] = size
+        self.reserved_entries += size
+
+    def miss(self):
+        """Called by caches on a miss, to resize them now and then."""
+        self.countdown -= 1
+        if self.countdown <= 0:
+            self.rebalance()
+
+    def rebalance(self):
+        """Resize the caches to share the budget."""
+        self.countdown = self.interval
+        self.reserved_entries = sum(self.reserved.values())
+        self.allocated = 0
+        caches = list(self.caches)
+        if not caches:
+            return
+        available = self.entries - self.reserved_entries
+        minimum = self.minimum(available, len(caches))
+        sizes = dict.fromkeys(caches, minimum)
+        available -= minimum * len(caches)
+        rates = dict(
+            (cache, cache.hits / (len(cache) or 1)) for cache in caches
+        )
+        unbounded = set(caches)
+        # Share in proportion to hit rate, but don't give caches more
+        # than twice their current number of entries, as they wouldn't
+        # use it: give what's left over to the others.
+        while available > 0 and unbounded:
+            total_rate = sum(rates[cache] for cache in unbounded)
+            shares = {}
+            for cache in unbounded:
+                if total_rate:
+                    shares[cache] = int(available * rates[cache] / total_rate)
+                else:
+                    shares[cache] = available // len(unbounded)
+            bounded = set()
+            for cache in unbounded:
+                limit = max(2 * len(cache), minimum)
+                if sizes[cache] + shares[cache] > limit:
+                    bounded.add(cache)
+                    available -= limit - sizes[cache]
+                    sizes[cache] = limit
+            if not bounded:
+                for cache in unbounded:
+                    sizes[cache] += shares[cache]
+                break
+            unbounded -= bounded
+        for cache in caches:
+            cache.resize(sizes[cache])
+            cache.hits = cache.misses = 0
+        self.allocated = sum(sizes.values())
+
+
+_cache_budget = None
+
+
+def set_cache_budget(entries=None, bytes=None, **kw):
+    """Set the budget shared by caches that don't have a size.
+
+    The caches of :class:`reg.PolicyCachingKeyLookup` instances created
+    without sizes share this budget, and the caches of sized ones and
+    of :class:`reg.LruCachingKeyLookup` instances count against it.
+    Caches of the previous budget move over to the new one. The budget
+    can also be set with the ``REG_CACHE_BUDGET`` environment variable,
+    as a number of entries.
+
+    :param entries: the total number of cache entries.
+    :param bytes: the total size of the caches in bytes, as an
+      alternative to ``entries``.
+    :param kw: further arguments to :class:`reg.cache.CacheBudget`.
+    """
+    global _cache_budget
+    previous = _cache_budget
+    _cache_budget = CacheBudget(entries, bytes, **kw)
+    if previous is not None:
+        for cache, size in list(previous.reserved.items()):
+            _cache_budget.reserve(cache, size)
+        for cache in list(previous.caches):
+            _cache_budget.add(cache)
+        _cache_budget.rebalance()
+
+
+def cache_budget():
+    """The budget shared by caches that don't have a size.
+
+    :returns: a :class:`reg.cache.CacheBudget`. If no budget was set,
+      one is created with the number of entries given by the
+      ``REG_CACHE_BUDGET`` environment variable, or 100000 entries.
+      A value that isn't a number of entries is ignored with a
+      warning.
+    """
+    if _cache_budget is None:
+        set_cache_budget(_budget_from_environ())
+    return _cache_budget
+
+
+def _budget_from_environ():
+    # Caches of a fixed size count against the budget too, so this
+    # mustn't fail for code that never asked for a budget.
+    value = os.environ.get("REG_CACHE_BUDGET")
+    if not value:
+        return 100000
+    try:
+        entries = int(value)
+    except ValueError:
+        entries = 0
+    if entries < 1:
+        warnings.warn(
+            "Ignoring REG_CACHE_BUDGET=%r, "
+            "which is not a number of entries" % value
+        )
+        entries = 100000
+    return entries
+
+
+def first(all):
+    """Get the first of the matches of a key, as cached by ``all``.
+
+    Caching key lookups compute the matches of a key once, for both
+    their ``component`` and ``all`` caches.
+
+    :param all: a function that gets a predicate key and returns a
+      tuple of the values matching it.
+    :returns: a function that gets a predicate key and returns the
+      first value matching it, or ``None``.
+    """
+
+    def component(key):
+        matches = all(key)
+        return matches[0] if matches else None
+
+    return component
+
+
+def matches(key_lookup):
+    """Get the values matching a key as a tuple, to be cached."""
+    return lambda key: tuple(key_lookup.all(key))
+
+
+class CachingKeyLookup(object):
+    """Base class of the key lookups that cache.
+
+    Subclasses cache the :meth:`all`, :meth:`component` and
+    :meth:`fallback` lookups of the :class:`PredicateRegistry` they
+    are given.
+    """
+
+    def caches(self):
+        """The caches of the ``all``, ``component`` and ``fallback``
+        lookups."""
+        return (
+            self.all.__self__,
+            self.component.__self__,
+            self.fallback.__self__,
+        )
+
+    def clear(self):
+        """Empty the caches.
+
+        Dispatch functions call this when an implementation is
+        registered, as the cached lookups may no longer be right.
+        """
+        for cache in self.caches():
+            cache.clear()
+
+
+class DictCachingKeyLookup(CachingKeyLookup):
     """A key lookup that caches.
 
     Implements the read-only API of :class:`reg.PredicateRegistry` using
@@ -30,12 +681,16 @@ class DictCachingKeyLookup(object):
 
     def __init__(self, key_lookup):
         self.key_lookup = key_lookup
-        self.component = Cache(key_lookup.component).__getitem__
+        self.all = Cache(matches(key_lookup)).__getitem__
+        self.component = Cache(first(self.all)).__getitem__
         self.fallback = Cache(key_lookup.fallback).__getitem__
-        self.all = Cache(lambda key: list(key_lookup.all(key))).__getitem__
 
+    def cached_keys(self):
+        """The predicate keys of the cached component lookups."""
+        return list(self.component.__self__)
 
-class LruCachingKeyLookup(object):
+
+class LruCachingKeyLookup(CachingKeyLookup):
     """A key lookup that caches.
 
     Implements the read-only API of :class:`reg.PredicateRegistry`, using
@@ -44,6 +699,8 @@ class LruCachingKeyLookup(object):
     The cache is LRU so won't grow beyond a certain limit, preserving
     memory. This is only useful if you except the access pattern to
     your function to involve a huge range of different predicate keys.
+    Its caches count against the :func:`reg.cache_budget` shared by
+    caches without a size.
 
     :param: key_lookup - the :class:`PredicateRegistry` to cache.
     :param component_cache_size: how many cache entries to store for
@@ -51,6 +708,7 @@ class LruCachingKeyLookup(object):
       calls.
     :param all_cache_size: how many cache entries to store for the
       the :meth:`all` method.
+      Lookups that miss the :meth:`component` cache go through it.
     :param fallback_cache_size: how many cache entries to store for
       the :meth:`fallback` method.
     """
@@ -63,8 +721,208 @@ class LruCachingKeyLookup(object):
         fallback_cache_size,
     ):
         self.key_lookup = key_lookup
-        self.component = lru_cache(component_cache_size)(key_lookup.component)
+        self.all = lru_cache(all_cache_size)(matches(key_lookup))
+        self.component = lru_cache(component_cache_size)(first(self.all))
         self.fallback = lru_cache(fallback_cache_size)(key_lookup.fallback)
-        self.all = lru_cache(all_cache_size)(
-            lambda key: list(key_lookup.all(key))
+        budget = cache_budget()
+        budget.reserve(self.all._cache, all_cache_size)
+        budget.reserve(self.component._cache, component_cache_size)
+        budget.reserve(self.fallback._cache, fallback_cache_size)
+
+    def cached_keys(self):
+        """The predicate keys of the cached component lookups."""
+        return [args[0] for args in list(self.component._cache.data)]
+
+    def caches(self):
+        return tuple(
+            func._cache for func in (self.all, self.component, self.fallback)
+        )
+
+    def clear(self):
+        # clearing allocates the whole cache again, so only do it
+        # when there's anything to clear
+        for cache in self.caches():
+            if cache.data:
+                cache.clear()
+
+
+class PolicyCachingKeyLookup(CachingKeyLookup):
+    """A key lookup that caches, with a choice of eviction policy.
+
+    Implements the read-only API of :class:`reg.PredicateRegistry`,
+    using a cache to speed up access.
+
+    Like :class:`reg.LruCachingKeyLookup`, its caches won't grow beyond
+    a certain limit. The eviction policy decides which entries to keep:
+
+    ``"lru"``
+      The least recently used entries are evicted, as with
+      :class:`reg.LruCachingKeyLookup`.
+
+    ``"2q"``, ``"arc"``
+      Entries that are used repeatedly are kept in favor of entries
+      that are used only once, so that calling the dispatch with a
+      long series of different predicate keys, for instance in a batch
+      job, doesn't evict the entries used by the rest of the
+      application.
+
+    :param: key_lookup - the :class:`PredicateRegistry` to cache.
+    :param component_cache_size: how many cache entries to store for
+      the :meth:`component` method. This is also used by dispatch
+      calls.
+    :param all_cache_size: how many cache entries to store for the
+      the :meth:`all` method.
+      Lookups that miss the :meth:`component` cache go through it.
+    :param fallback_cache_size: how many cache entries to store for
+      the :meth:`fallback` method.
+    :param policy: the name of the eviction policy, or a class
+      implementing it, such as :class:`reg.cache.TwoQueueCache`.
+
+    Sizes that are not given are managed by the process-wide
+    :func:`reg.cache_budget`, which shares a single budget between
+    the caches of all dispatch functions according to their hit rate.
+    Caches with a size count against that budget.
+    """
+
+    def __init__(
+        self,
+        key_lookup,
+        component_cache_size=None,
+        all_cache_size=None,
+        fallback_cache_size=None,
+        policy="2q",
+    ):
+        self.key_lookup = key_lookup
+        policy = POLICIES.get(policy, policy)
+
+        def cache(func, size):
+            if size is not None:
+                result = policy(func, size)
+                cache_budget().reserve(result, size)
+                return result
+            result = policy(func, 1)
+            cache_budget().add(result)
+            return result
+
+        self.all = cache(matches(key_lookup), all_cache_size).__getitem__
+        self.component = cache(
+            first(self.all), component_cache_size
+        ).__getitem__
+        self.fallback = cache(
+            key_lookup.fallback, fallback_cache_size
+        ).__getitem__
+
+    def cached_keys(self):
+        """The predicate keys of the cached component lookups."""
+        return self.component.__self__.keys()
+
+
+class AdaptiveCachingKeyLookup(CachingKeyLookup):
+    """A key lookup that caches, and becomes bounded as needed.
+
+    Implements the read-only API of :class:`reg.PredicateRegistry`,
+    using a cache to speed up access.
+
+    The cache behaves like that of :class:`reg.DictCachingKeyLookup`
+    for as long as the dispatch in question is called with a small
+    range of predicate keys. If that range turns out to be large, or
+    most calls are made with new keys, it starts to evict the least
+    recently used entries, like :class:`reg.LruCachingKeyLookup`. Use
+    this if you don't know in advance how many different predicate
+    keys to expect. See :class:`reg.cache.GenerationalCache`.
+
+    :param: key_lookup - the :class:`PredicateRegistry` to cache.
+    :param component_cache_size: how many cache entries to store for
+      the :meth:`component` method before becoming bounded. This is
+      also used by dispatch calls.
+    :param all_cache_size: how many cache entries to store for the
+      the :meth:`all` method before becoming bounded.
+      Lookups that miss the :meth:`component` cache go through it.
+    :param fallback_cache_size: how many cache entries to store for
+      the :meth:`fallback` method before becoming bounded.
+    """
+
+    def __init__(
+        self,
+        key_lookup,
+        component_cache_size=5000,
+        all_cache_size=5000,
+        fallback_cache_size=5000,
+    ):
+        self.key_lookup = key_lookup
+        self.all = GenerationalCache(
+            matches(key_lookup), all_cache_size
+        ).__getitem__
+        self.component = GenerationalCache(
+            first(self.all), component_cache_size
+        ).__getitem__
+        self.fallback = GenerationalCache(
+            key_lookup.fallback, fallback_cache_size
+        ).__getitem__
+
+    def cached_keys(self):
+        """The predicate keys of the cached component lookups."""
+        return self.component.__self__.cached_keys()
+
+
+def key_lookup_from_spec(spec):
+    """Get a key lookup from its specification.
+
+    The specification is the name of a caching key lookup, followed by
+    its parameters, separated by colons:
+
+    ``identity``, or an empty string
+      No caching: the :class:`reg.PredicateRegistry` is used directly.
+
+    ``dict``
+      A :class:`reg.DictCachingKeyLookup`.
+
+    ``lru:<size>``
+      A :class:`reg.LruCachingKeyLookup` with ``size`` entries for
+      each of its caches.
+
+    ``2q[:<size>]``, ``arc[:<size>]``
+      A :class:`reg.PolicyCachingKeyLookup` with ``size`` entries for
+      each of its caches, using the eviction policy of that name.
+      Without a size, the caches share the :func:`reg.cache_budget`.
+
+    ``adaptive[:<size>]``
+      A :class:`reg.AdaptiveCachingKeyLookup`, becoming bounded once
+      one of its caches holds ``size`` entries.
+
+    :param spec: the specification.
+    :returns: a function that gets a :class:`reg.PredicateRegistry`
+      instance and returns a key lookup, or ``None`` if no caching is
+      specified.
+    """
+    name, _, params = spec.strip().partition(":")
+    if name in ("", "identity"):
+        return None
+    if name == "dict":
+        return DictCachingKeyLookup
+    if name in POLICIES and not params:
+        return lambda key_lookup: PolicyCachingKeyLookup(
+            key_lookup, policy=name
+        )
+    if name == "lru" or name in POLICIES:
+        try:
+            size = int(params)
+        except ValueError:
+            raise ValueError(
+                "Key lookup %r needs a size, as in '%s:5000'" % (spec, name)
+            )
+        if name == "lru":
+            return lambda key_lookup: LruCachingKeyLookup(
+                key_lookup, size, size, size
+            )
+        return lambda key_lookup: PolicyCachingKeyLookup(
+            key_lookup, size, size, size, name
+        )
+    if name == "adaptive":
+        if not params:
+            return AdaptiveCachingKeyLookup
+        size = int(params)
+        return lambda key_lookup: AdaptiveCachingKeyLookup(
+            key_lookup, size, size, size
         )
+    raise ValueError("Unknown key lookup: %r" % spec)
@@ -0,0 +1,275 @@
+"""Compile dispatch functions ahead of time into an importable module.
+
+In a closed-world deployment, all dispatch functions and their
+implementations are known once the application is configured. Run::
+
+  python -m reg.compile myapp.config -o _reg_tables.py
+
+to import ``myapp.config`` and write a module with the code of the
+generated dispatch functions and their registrations. Then start the
+application with::
+
+  import reg.compile
+  import _reg_tables
+
+  reg.compile.load_code(_reg_tables)
+  import myapp.views
+  if not reg.compile.load_tables(_reg_tables):
+      ...  # register as usual
+
+The generated code is imported from ``__pycache__`` rather than
+compiled, and registrations are restored without going through
+:meth:`reg.Dispatch.register`. Dispatch functions whose
+implementations or keys can't be referenced by module and qualified
+name, such as functions defined in another function, can't be
+restored: they are listed in ``SKIPPED``, and
+:func:`load_tables` refuses to restore the registrations of the
+others.
+"""
+
+import argparse
+import importlib
+import pprint
+import sys
+import textwrap
+
+from .dispatch import (
+    _dispatches,
+    _compiled,
+    _recorded_sources,
+    dotted_name,
+    inner_code,
+    validate_signature,
+)
+from .error import RegistrationError
+from .warmup import encode_key_part, decode_key_part, resolve, _skip
+
+VERSION = 1
+
+module_template = '''\
+# flake8: noqa
+"""Dispatch functions compiled ahead of time by ``python -m reg.compile``.
+
+Do not edit: generate it again instead.
+"""
+
+VERSION = {version}
+
+
+{functions}
+
+
+CODE = {{
+{code}}}
+
+TABLES = {tables}
+
+SKIPPED = {skipped}
+'''
+
+
+def reference(obj):
+    """Reference an object by module and qualified name.
+
+    :returns: a ``module:qualname`` string, or ``None`` if the object
+      can't be found back that way.
+    """
+    module = getattr(obj, "__module__", None)
+    qualname = getattr(obj, "__qualname__", None)
+    if module is None or qualname is None or "<locals>" in qualname:
+        return None
+    result = "{}:{}".format(module, qualname)
+    if resolve(result) is not obj:
+        return None
+    return result
+
+
+def dispatch_table(d):
+    """The registrations of a dispatch function, referenced by name.
+
+    :param d: a :class:`reg.Dispatch` instance.
+    :returns: a tuple of the predicate names and a list of
+      ``(encoded key, implementation reference)`` pairs, or ``None``
+      if some of the registrations can't be referenced.
+    """
+    registry = d.registry
+    registrations = []
+    for key in sorted(registry.known_keys, key=repr):
+        value = reference(registry.exact[key])
+        encoded = tuple(encode_key_part(part) for part in key)
+        if value is None or None in encoded:
+            return None
+        registrations.append((encoded, value))
+    return tuple(p.name for p in d.predicates), registrations
+
+
+def compile_modules(module_names):
+    """Import modules and compile their dispatch functions.
+
+    The modules should be imported for the first time, so that the
+    code of the dispatch functions they define can be recorded.
+
+    :param module_names: the dotted names of the modules to import.
+    :returns: the source code of the generated module.
+    """
+    sources = set()
+    _recorded_sources.append(sources)
+    try:
+        for name in module_names:
+            importlib.import_module(name)
+    finally:
+        _recorded_sources.remove(sources)
+
+    functions = []
+    code = []
+    for i, source in enumerate(sorted(sources)):
+        functions.append(
+            "def _code_{}():\n{}".format(
+                i, textwrap.indent(source.rstrip("\n"), "    ")
+            )
+        )
+        code.append("    {!r}: _code_{}.__code__,\n".format(source, i))
+
+    by_name = {}
+    for d in list(_dispatches):
+        if d.registry.known_keys:
+            by_name.setdefault(dotted_name(d.wrapped_func), []).append(d)
+    tables = {}
+    skipped = []
+    for name, found in by_name.items():
+        # dispatch methods of subclasses share their name, so we
+        # wouldn't know which one to restore
+        table = dispatch_table(found[0]) if len(found) == 1 else None
+        if table is None:
+            skipped.append(name)
+        else:
+            tables[name] = table
+
+    return module_template.format(
+        version=VERSION,
+        functions="\n\n\n".join(functions),
+        code="".join(code),
+        tables=pprint.pformat(tables),
+        skipped=pprint.pformat(sorted(skipped)),
+    )
+
+
+def _load(module):
+    if isinstance(module, str):
+        module = importlib.import_module(module)
+    if getattr(module, "VERSION", None) != VERSION:
+        return None
+    return module
+
+
+def load_code(module):
+    """Use the code compiled in a generated module.
+
+    Call this before the dispatch functions are defined, so that they
+    don't compile their code.
+
+    :param module: the generated module, or its dotted name.
+    :returns: the number of code objects loaded.
+    """
+    module = _load(module)
+    if module is None:
+        return 0
+    _compiled.update(
+        (source, inner_code(code)) for source, code in module.CODE.items()
+    )
+    return len(module.CODE)
+
+
+def _import_resolve(ref):
+    try:
+        importlib.import_module(ref.partition(":")[0])
+    except ImportError:
+        return None
+    return resolve(ref)
+
+
+def _decode_table(registrations):
+    result = []
+    for encoded, value in registrations:
+        for part in encoded:
+            if isinstance(part, dict):
+                _import_resolve(str(part.get("class")))
+        key = tuple(decode_key_part(part) for part in encoded)
+        func = _import_resolve(value)
+        if func is None or any(part is _skip for part in key):
+            return None
+        result.append((key, func))
+    return result
+
+
+def load_tables(module):
+    """Restore the registrations saved in a generated module.
+
+    Call this once the dispatch functions are defined. Registrations
+    are restored all at once, or not at all: nothing is restored unless
+    all saved dispatch functions are found without registrations and
+    with the same predicates as when the module was generated, and all
+    their implementations are found. These are checked against the
+    signature of their dispatch function, as
+    :meth:`reg.Dispatch.register` does.
+
+    :param module: the generated module, or its dotted name.
+    :returns: the dotted names of the restored dispatch functions, or
+      an empty list if nothing was restored.
+    :raises: :exc:`reg.RegistrationError` if the module lists dispatch
+      functions whose registrations couldn't be saved, as restoring
+      the others would leave these without registrations.
+    """
+    module = _load(module)
+    if module is None:
+        return []
+    if module.SKIPPED:
+        raise RegistrationError(
+            "Registrations of %s were not compiled, register as usual "
+            "instead" % ", ".join(module.SKIPPED)
+        )
+    by_name = {}
+    for d in list(_dispatches):
+        by_name.setdefault(dotted_name(d.wrapped_func), []).append(d)
+    restore = []
+    for name, (predicate_names, registrations) in module.TABLES.items():
+        found = by_name.get(name, ())
+        if len(found) != 1:
+            return []
+        d = found[0]
+        if d.registry.known_keys or predicate_names != tuple(
+            p.name for p in d.predicates
+        ):
+            return []
+        table = _decode_table(registrations)
+        if table is None:
+            return []
+        # implementations are often registered for several keys
+        for func in set(func for key, func in table):
+            validate_signature(func, d.wrapped_func)
+        restore.append((name, d, table))
+    for name, d, table in restore:
+        d.registry.register_all(table)
+    return sorted(name for name, d, table in restore)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m reg.compile",
+        description="Compile dispatch functions ahead of time.",
+    )
+    parser.add_argument("modules", nargs="+", help="modules to import")
+    parser.add_argument(
+        "-o", "--output", help="file to write, by default standard output"
+    )
+    args = parser.parse_args(argv)
+    source = compile_modules(args.modules)
+    if args.output is None:
+        sys.stdout.write(source)
+    else:
+        with open(args.output, "w") as f:
+            f.write(source)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
@@ -1,7 +1,14 @@
 from __future__ import unicode_literals
 import inspect
 from types import MethodType
-from .dispatch import dispatch, Dispatch, format_signature, execute
+from .dispatch import (
+    dispatch,
+    Dispatch,
+    format_signature,
+    make_function,
+    dotted_name,
+    qualified_name,
+)
 from .arginfo import arginfo
 
 
@@ -128,7 +135,13 @@ def methodify(func, selfname=None):
     code_source = code_template.format(
         signature=format_signature(args), selfname=selfname or "_"
     )
-    return execute(code_source, _func=func)["wrapper"]
+    return make_function(
+        code_source,
+        "<methodify {}>".format(dotted_name(func)),
+        getattr(func, "__name__", "wrapper"),
+        qualified_name(func),
+        _func=func,
+    )
 
 
 def clean_dispatch_methods(cls):
@@ -1,10 +1,26 @@
 from __future__ import unicode_literals
+import os
+import sys
+import textwrap
+import warnings
+import weakref
 from functools import partial, wraps
 from collections import namedtuple
+from types import CodeType, FunctionType
 from .predicate import match_instance
-from .predicate import PredicateRegistry
+from .predicate import PredicateRegistry, ClassIndex
 from .arginfo import arginfo
 from .error import RegistrationError
+from .cache import key_lookup_from_spec
+from .instrument import (
+    metrics_enabled,
+    call_metrics,
+    key_histograms_size,
+    KeyHistogram,
+    slow_lookup_threshold,
+    WatchedKeyLookup,
+    perf_counter_ns,
+)
 
 
 class dispatch(object):
@@ -25,6 +41,8 @@ class dispatch(object):
       you can return a caching key lookup (such as
       :class:`reg.DictCachingKeyLookup` or
       :class:`reg.LruCachingKeyLookup`) to make it more efficient.
+      By default, the key lookup set with
+      :func:`reg.set_default_key_lookup` is used.
     :returns: a function that you can use as if it were a
       :class:`reg.Dispatch` instance.
 
@@ -34,7 +52,7 @@ class dispatch(object):
         self.predicates = [
             self._make_predicate(predicate) for predicate in predicates
         ]
-        self.get_key_lookup = kw.pop("get_key_lookup", identity)
+        self.get_key_lookup = kw.pop("get_key_lookup", None)
 
     def _make_predicate(self, predicate):
         if isinstance(predicate, str):
@@ -49,30 +67,195 @@ def identity(registry):
     return registry
 
 
+def default_key_lookup_from_environ():
+    """The default key lookup given by ``REG_KEY_LOOKUP``.
+
+    A specification that isn't understood is ignored with a warning,
+    rather than failing the import of reg.
+    """
+    spec = os.environ.get("REG_KEY_LOOKUP", "")
+    try:
+        return key_lookup_from_spec(spec) or identity
+    except ValueError as e:
+        warnings.warn("Ignoring REG_KEY_LOOKUP=%r: %s" % (spec, e))
+        return identity
+
+
+_default_key_lookup = default_key_lookup_from_environ()
+_uses_default_key_lookup = weakref.WeakSet()
+_dispatches = weakref.WeakSet()
+
+
+def set_default_key_lookup(get_key_lookup):
+    """Set the key lookup of dispatch functions that don't specify one.
+
+    This also applies to dispatch functions that are already defined,
+    which keep their registrations but start off with an empty cache.
+    The default can also be set with the ``REG_KEY_LOOKUP``
+    environment variable, which takes the same specifications as this
+    function.
+
+    :param get_key_lookup: a function that gets a
+      :class:`PredicateRegistry` instance and returns a key lookup, or
+      a specification such as ``"dict"`` or ``"lru:5000"``, as
+      understood by :func:`reg.key_lookup_from_spec`. ``None``
+      restores the uncached default.
+    """
+    global _default_key_lookup
+    if get_key_lookup is None or isinstance(get_key_lookup, str):
+        get_key_lookup = key_lookup_from_spec(get_key_lookup or "")
+    _default_key_lookup = get_key_lookup or identity
+    for d in list(_uses_default_key_lookup):
+        d._bind_key_lookup()
+
+
+_unresolved = object()
+
+
 class LookupEntry(namedtuple("LookupEntry", "lookup key")):
-    """The dispatch data associated to a key."""
+    """The dispatch data associated to a key.
+
+    When the key lookup has a ``generation``, as
+    :class:`reg.PredicateRegistry` does, the component, fallback and
+    matches are looked up the first time they are used, and then
+    remembered until an implementation is registered. Caching key
+    lookups are asked each time, as that is as fast.
+    """
 
-    __slots__ = ()
+    # no __slots__, so that entries can remember what they looked up
+    # in their __dict__, as a list of the generation it is valid for,
+    # the component, the fallback and the matches.
+
+    def _memo(self, generation):
+        memo = self.__dict__.get("_resolved")
+        if memo is None or memo[0] != generation:
+            memo = self.__dict__["_resolved"] = [
+                generation,
+                _unresolved,
+                _unresolved,
+                _unresolved,
+            ]
+        return memo
 
     @property
     def component(self):
         """The function to dispatch to, excluding fallbacks."""
-        return self.lookup.component(self.key)
+        lookup = self[0]
+        generation = getattr(lookup, "generation", None)
+        if generation is None:
+            return lookup.component(self[1])
+        memo = self._memo(generation)
+        result = memo[1]
+        if result is _unresolved:
+            result = memo[1] = lookup.component(self[1])
+        return result
 
     @property
     def fallback(self):
         """The approriate fallback implementation."""
-        return self.lookup.fallback(self.key)
+        lookup = self[0]
+        generation = getattr(lookup, "generation", None)
+        if generation is None:
+            return lookup.fallback(self[1])
+        memo = self._memo(generation)
+        result = memo[2]
+        if result is _unresolved:
+            result = memo[2] = lookup.fallback(self[1])
+        return result
 
     @property
     def matches(self):
         """An iterator over all the compatible implementations."""
-        return self.lookup.all(self.key)
+        return iter(self._all())
 
     @property
     def all_matches(self):
         """The list of all compatible implementations."""
-        return list(self.matches)
+        return list(self._all())
+
+    def _all(self):
+        lookup = self[0]
+        generation = getattr(lookup, "generation", None)
+        if generation is None:
+            return lookup.all(self[1])
+        memo = self._memo(generation)
+        result = memo[3]
+        if result is _unresolved:
+            result = memo[3] = tuple(lookup.all(self[1]))
+        return result
+
+
+# The templates of the generated call function. All the variants a
+# dispatch function switches between must have the same free
+# variables, so they all refer to them after returning.
+_specialized_cells = (
+    "_registry_key",
+    "_component_lookup",
+    "_fallback_lookup",
+    "_fallback",
+    "_target",
+    "_single_key",
+    "_inline_cache",
+    "_remember",
+)
+
+_general_call_template = """\
+def call({signature}):
+    _key = _registry_key({predicate_args})
+{sample}    return (_component_lookup(_key) or
+            _fallback_lookup(_key) or
+            _fallback)({signature})
+    {cells}
+"""
+
+_empty_call_template = """\
+def call({signature}):
+    return _target({signature})
+    {cells}
+"""
+
+_single_call_template = """\
+def call({signature}):
+    if {checks}:
+        return _target({signature})
+    _key = _registry_key({predicate_args})
+    return (_component_lookup(_key) or
+            _fallback_lookup(_key) or
+            _fallback)({signature})
+    {cells}
+"""
+
+_polymorphic_call_template = """\
+def call({signature}):
+    _c = _inline_cache
+    if {checks0}:
+        return _c[{target0}]({signature})
+    if {checks1}:
+        return _c[{target1}]({signature})
+    _key = _registry_key({predicate_args})
+    _func = (_component_lookup(_key) or
+             _fallback_lookup(_key) or
+             _fallback)
+    _remember(_key, _func)
+    return _func({signature})
+    {cells}
+"""
+
+# The template of the generated predicate_key function, which builds
+# the key inline when all predicates can.
+_predicate_key_cell_names = ("_registry_key", "_key_lookup", "_return_type")
+
+_predicate_key_template = """\
+def predicate_key({signature}):
+    return _return_type(_key_lookup, {key})
+    {cells}
+"""
+
+# The number of inline cache misses after which a polymorphic call
+# gives up on its inline cache.
+MEGAMORPHIC_MISSES = 1000
+
+_nomatch = object()
 
 
 class Dispatch(object):
@@ -93,11 +276,16 @@ class Dispatch(object):
       you can return a caching key lookup (such as
       :class:`reg.DictCachingKeyLookup` or
       :class:`reg.LruCachingKeyLookup`) to make it more efficient.
+      If ``None``, the key lookup set with
+      :func:`reg.set_default_key_lookup` is used.
     """
 
     def __init__(self, predicates, callable, get_key_lookup):
         self.wrapped_func = callable
         self.get_key_lookup = get_key_lookup
+        if get_key_lookup is None:
+            _uses_default_key_lookup.add(self)
+        _dispatches.add(self)
         self._original_predicates = predicates
         self._define_call()
         self._register_predicates(predicates)
@@ -105,48 +293,238 @@ class Dispatch(object):
     def _register_predicates(self, predicates):
         self.registry = PredicateRegistry(*predicates)
         self.predicates = predicates
-        self.call.key_lookup = self.key_lookup = self.get_key_lookup(
-            self.registry
+        self._misses = 0
+        self.registry.listeners.append(self._registered)
+        self._bind_key_lookup()
+        self._specialize_predicate_key()
+
+    def _registered(self):
+        # Called by the registry when an implementation is registered.
+        # A caching key lookup may have cached results that this
+        # changes, so its caches are emptied: the key lookup itself is
+        # kept, as it may be one of its own.
+        clear = getattr(self.key_lookup, "clear", None)
+        if clear is not None:
+            clear()
+        if self._specialized:
+            self._specialize()
+
+    def _bind_key_lookup(self):
+        key_lookup = self.registry
+        threshold_ns = slow_lookup_threshold()
+        if threshold_ns:
+            key_lookup = WatchedKeyLookup(
+                key_lookup, dotted_name(self.wrapped_func), threshold_ns
+            )
+        get_key_lookup = self.get_key_lookup or _default_key_lookup
+        self.call.key_lookup = self.key_lookup = get_key_lookup(key_lookup)
+        # The generated functions get these through closure cells
+        # rather than globals: changing globals would invalidate the
+        # global lookups specialized by the interpreter.
+        cells = self._call_cells
+        set_cell(cells["_registry_key"], self.registry.key)
+        set_cell(cells["_component_lookup"], self.key_lookup.component)
+        set_cell(cells["_fallback_lookup"], self.key_lookup.fallback)
+        cells = self._predicate_key_cells
+        set_cell(cells["_registry_key"], self.registry.key)
+        set_cell(cells["_key_lookup"], self.key_lookup)
+        if self._specialized:
+            self._specialize()
+
+    def _specialize(self):
+        # Regenerate call for the current state of the registry: with
+        # no registrations, it goes straight to the fallback, with a
+        # single one, it checks the key for it first, and with more, it
+        # checks the keys of the last calls first, unless these keep on
+        # changing. Going straight to the fallback skips the key lookup
+        # and the computation of the key, so this is only done when
+        # neither can be observed.
+        registry = self.registry
+        cells = self._call_cells
+        code_template = _general_call_template
+        inline_keys = self._inline_keys()
+        inline = len(inline_keys) == len(self.predicates)
+        if not registry.known_keys and inline and self.key_lookup is registry:
+            fallback = (
+                registry.indexes[0].fallback if registry.indexes else None
+            )
+            set_cell(cells["_target"], fallback or self.wrapped_func)
+            code_template = _empty_call_template
+        elif len(registry.known_keys) == 1 and inline:
+            (key,) = registry.known_keys
+            set_cell(cells["_single_key"], key)
+            set_cell(cells["_target"], registry.exact[key])
+            checks = self._inline_checks(inline_keys, "_single_key", 0)
+            code_template = _single_call_template.replace(
+                "{checks}", checks or "True"
+            )
+        elif inline_keys and inline and self._misses < MEGAMORPHIC_MISSES:
+            # The inline cache holds the key and implementation of the
+            # last call, then those of the call before, so without
+            # predicates there is nothing for it to check. It is a tuple
+            # that a miss replaces as a whole, and that call reads once,
+            # so that concurrent calls never see half of an entry.
+            size = len(inline_keys) + 1
+            set_cell(cells["_inline_cache"], (_nomatch,) * (2 * size))
+            code_template = _polymorphic_call_template
+            for entry in range(2):
+                checks = self._inline_checks(inline_keys, "_c", entry * size)
+                code_template = code_template.replace(
+                    "{{checks{}}}".format(entry), checks
+                ).replace(
+                    "{{target{}}}".format(entry),
+                    str(entry * size + size - 1),
+                )
+        code_source = code_template.format(
+            signature=self._signature,
+            predicate_args=self._predicate_args,
+            sample="",
+            cells=", ".join(_specialized_cells),
         )
-        self.call.__globals__.update(
-            _registry_key=self.registry.key,
-            _component_lookup=self.key_lookup.component,
-            _fallback_lookup=self.key_lookup.fallback,
+        if code_source != self._call_source:
+            self._call_source = code_source
+            self.call.__code__ = closure_code(
+                code_source, _specialized_cells, *self._code_names
+            )
+
+    def _inline_keys(self):
+        return [
+            p.inline_key.format(p.name)
+            for p in self.predicates
+            if p.inline_key and p.name in self._arg_names
+        ]
+
+    def _inline_checks(self, inline_keys, keys, offset):
+        # Classes are compared by identity, other keys by equality, as
+        # keys such as strings built at runtime are equal without being
+        # the same object.
+        return " and ".join(
+            "{} {} {}[{}]".format(
+                inline_key,
+                "is" if issubclass(p.index, ClassIndex) else "==",
+                keys,
+                offset + i,
+            )
+            for i, (p, inline_key) in enumerate(
+                zip(self.predicates, inline_keys)
+            )
         )
-        self._predicate_key.__globals__.update(
-            _registry_key=self.registry.key,
-            _return_type=partial(LookupEntry, self.key_lookup),
+
+    def _specialize_predicate_key(self):
+        # Regenerate predicate_key for the current predicates: it
+        # builds the key itself if they all have an inline key.
+        inline_keys = self._inline_keys()
+        if len(inline_keys) == len(self.predicates):
+            key = "({})".format("".join(k + ", " for k in inline_keys))
+        else:
+            key = "_registry_key({})".format(self._predicate_args)
+        code_source = _predicate_key_template.format(
+            signature=self._signature,
+            key=key,
+            cells=", ".join(_predicate_key_cell_names),
         )
+        if code_source != self._predicate_key_source:
+            self._predicate_key_source = code_source
+            self._predicate_key.__code__ = closure_code(
+                code_source,
+                _predicate_key_cell_names,
+                *self._predicate_key_code_names
+            )
+
+    def _remember(self, key, func):
+        # Called by the polymorphic call on a miss of its inline cache.
+        cell = self._call_cells["_inline_cache"]
+        cache = cell.cell_contents
+        set_cell(cell, key + (func,) + cache[: len(key) + 1])
+        self._misses += 1
+        if self._misses == MEGAMORPHIC_MISSES:
+            self._specialize()
 
     def _define_call(self):
         # We build the generic function on the fly. Its definition
         # requires the signature of the wrapped function and the
         # arguments needed by the registered predicates
         # (predicate_args):
-        code_template = """\
+        code_template = _general_call_template
+        name = dotted_name(self.wrapped_func)
+        namespace = {}
+        if metrics_enabled():
+            # Same as above, but timing each step. This is only
+            # compiled in when metrics are enabled, so that the plain
+            # version doesn't pay for it.
+            code_template = """\
 def call({signature}):
+    _start = _perf_counter_ns()
     _key = _registry_key({predicate_args})
-    return (_component_lookup(_key) or
-            _fallback_lookup(_key) or
-            _fallback)({signature})
+{sample}    _keyed = _perf_counter_ns()
+    _func = (_component_lookup(_key) or
+             _fallback_lookup(_key) or
+             _fallback)
+    _looked_up = _perf_counter_ns()
+    try:
+        return _func({signature})
+    finally:
+        _record(_start, _keyed, _looked_up, _perf_counter_ns())
 """
+            namespace.update(
+                _perf_counter_ns=perf_counter_ns,
+                _record=call_metrics(name).record,
+            )
+
+        # Likewise, keys are only sampled when key histograms are
+        # enabled.
+        sample = ""
+        self._key_histogram = None
+        histogram_size = key_histograms_size()
+        if histogram_size:
+            sample = "    _sample(_key)\n"
+            self._key_histogram = KeyHistogram(histogram_size)
+            namespace.update(_sample=self._key_histogram.add)
+
+        # Instrumented functions aren't specialized to the state of the
+        # registry, as that would bypass the instrumentation.
+        self._specialized = not namespace
+        if self._specialized:
+            namespace.update(
+                _target=None,
+                _single_key=None,
+                _inline_cache=None,
+                _remember=self._remember,
+            )
 
         args = arginfo(self.wrapped_func)
         signature = format_signature(args)
         predicate_args = ", ".join("{0}={0}".format(x) for x in args.args)
         code_source = code_template.format(
-            signature=signature, predicate_args=predicate_args
+            signature=signature,
+            predicate_args=predicate_args,
+            sample=sample,
+            cells=", ".join(_specialized_cells),
+        )
+        self._signature = signature
+        self._predicate_args = predicate_args
+        self._arg_names = args.args
+        self._call_source = code_source
+
+        # We now compile call to byte-code, under a file name of its
+        # own so that profilers can tell dispatch functions apart:
+        filename = "<dispatch {}>".format(name)
+        qualname = qualified_name(self.wrapped_func)
+        self._code_names = (
+            filename,
+            getattr(self.wrapped_func, "__name__", "call"),
+            qualname,
         )
-
-        # We now compile call to byte-code:
         self.call = call = wraps(self.wrapped_func)(
-            execute(
+            make_closure(
                 code_source,
+                *self._code_names,
                 _registry_key=None,
                 _component_lookup=None,
                 _fallback_lookup=None,
                 _fallback=self.wrapped_func,
-            )["call"]
+                **namespace
+            )
         )
 
         # We copy over the defaults from the wrapped function.
@@ -157,16 +535,29 @@ def call({signature}):
             if not k.startswith("_"):
                 setattr(call, k, getattr(self, k))
         call.wrapped_func = self.wrapped_func
+        self._call_cells = closure_cells(call)
 
         # We now build the implementation for the predicate_key method
-        self._predicate_key = execute(
-            "def predicate_key({signature}):\n"
-            "    return _return_type(_registry_key({predicate_args}))".format(
-                signature=format_signature(args), predicate_args=predicate_args
-            ),
+        code_source = _predicate_key_template.format(
+            signature=signature,
+            key="_registry_key({})".format(predicate_args),
+            cells=", ".join(_predicate_key_cell_names),
+        )
+        self._predicate_key_source = code_source
+        self._predicate_key_code_names = (
+            filename,
+            "predicate_key",
+            qualname + ".predicate_key",
+        )
+        self._predicate_key = make_closure(
+            code_source,
+            *self._predicate_key_code_names,
             _registry_key=None,
-            _return_type=None,
-        )["predicate_key"]
+            _key_lookup=None,
+            _return_type=LookupEntry,
+        )
+        self._predicate_key.__defaults__ = args.defaults
+        self._predicate_key_cells = closure_cells(self._predicate_key)
 
     def clean(self):
         """Clean up implementations and added predicates.
@@ -212,6 +603,18 @@ def call({signature}):
         self.registry.register(predicate_key, func)
         return func
 
+    def key_histogram(self):
+        """Frequencies of the dispatch keys this function was called with.
+
+        Keys are only sampled if key histograms were enabled with
+        :func:`reg.enable_key_histograms` when this dispatch function
+        was defined.
+
+        :returns: a :class:`reg.KeyHistogram`, or ``None`` if keys
+          aren't sampled.
+        """
+        return self._key_histogram
+
     def by_args(self, *args, **kw):
         """Lookup an implementation by invocation arguments.
 
@@ -270,10 +673,170 @@ def same_signature(a, b):
     )
 
 
-def execute(code_source, **namespace):
-    """Execute code in a namespace, returning the namespace."""
-    code_object = compile(
-        code_source, "<generated code: {}>".format(code_source), "exec"
+def qualified_name(func):
+    """Qualified name of a function, or of the class of a callable."""
+    return getattr(func, "__qualname__", None) or type(func).__qualname__
+
+
+def dotted_name(func):
+    """Module and qualified name of a function, separated by a dot."""
+    return "{}.{}".format(
+        getattr(func, "__module__", None), qualified_name(func)
+    )
+
+
+# The code of generated functions by source code, shared by all
+# functions generated from the same source, which reg.compile can load
+# ahead of time, and the sets in which reg.compile records the source
+# code to compile.
+_compiled = {}
+_recorded_sources = []
+
+
+def function_code(code_source):
+    """The code of the function defined by some source code.
+
+    The source code is only compiled the first time.
+    """
+    for sources in _recorded_sources:
+        sources.add(code_source)
+    code = _compiled.get(code_source)
+    if code is None:
+        code = _compiled[code_source] = inner_code(
+            compile(code_source, "<generated code>", "exec")
+        )
+    return code
+
+
+def inner_code(code):
+    """The code of the function defined by a code object."""
+    return next(c for c in code.co_consts if isinstance(c, CodeType))
+
+
+def rename_code(code, filename, name, qualname):
+    """Give generated code the name of the function it is used for.
+
+    Profilers report code objects rather than functions, so without
+    this all generated functions of a kind are reported as one. Code
+    loaded from a module generated by :mod:`reg.compile` keeps the file
+    name of that module, so that tracebacks can show its source.
+    """
+    if not code.co_filename.startswith("<"):
+        filename = code.co_filename
+    if hasattr(code, "co_qualname"):
+        return code.replace(
+            co_name=name, co_qualname=qualname, co_filename=filename
+        )
+    if hasattr(code, "replace"):  # pragma: no cover
+        return code.replace(co_name=name, co_filename=filename)
+    # Python 3.6 and 3.7
+    return CodeType(  # pragma: no cover
+        code.co_argcount,
+        code.co_kwonlyargcount,
+        code.co_nlocals,
+        code.co_stacksize,
+        code.co_flags,
+        code.co_code,
+        code.co_consts,
+        code.co_names,
+        code.co_varnames,
+        filename,
+        name,
+        code.co_firstlineno,
+        code.co_lnotab,
+        code.co_freevars,
+        code.co_cellvars,
+    )
+
+
+def make_function(code_source, filename, name, qualname, **namespace):
+    """Create a function from source code, with its own globals.
+
+    :param code_source: the source code defining the function.
+    :param filename: the file name reported for the code in tracebacks
+      and profiles.
+    :param name: the name of the function.
+    :param qualname: the qualified name of the function.
+    :param namespace: the globals of the function.
+    """
+    code = rename_code(function_code(code_source), filename, name, qualname)
+    func = FunctionType(code, namespace, name)
+    func.__qualname__ = qualname
+    return func
+
+
+def make_closure(code_source, filename, name, qualname, **cells):
+    """Create a function from source code, with its own closure.
+
+    The values of the closure cells can be changed later on, see
+    :func:`closure_cells`.
+
+    :param code_source: the source code defining the function.
+    :param filename: the file name reported for the code in tracebacks
+      and profiles.
+    :param name: the name of the function.
+    :param qualname: the qualified name of the function.
+    :param cells: the initial values of the free variables of the
+      function.
+    """
+    func = FunctionType(factory_code(code_source, cells), {})(**cells)
+    code = rename_code(func.__code__, filename, name, qualname)
+    func = FunctionType(code, func.__globals__, name, None, func.__closure__)
+    func.__qualname__ = qualname
+    return func
+
+
+def factory_code(code_source, names):
+    """The code of a function that creates a closure.
+
+    It takes the free variables of the function defined by
+    ``code_source`` as arguments, and returns the function.
+    """
+    defined = code_source[len("def ") : code_source.index("(")]
+    return function_code(
+        "def _make({}):\n{}\n    return {}\n".format(
+            ", ".join(sorted(names)),
+            textwrap.indent(code_source.rstrip("\n"), "    "),
+            defined,
+        )
     )
-    exec(code_object, namespace)
-    return namespace
+
+
+def closure_code(code_source, names, filename, name, qualname):
+    """The code of a closure created by :func:`make_closure`.
+
+    A function created by :func:`make_closure` with the same free
+    variables can be given this code.
+    """
+    code = inner_code(factory_code(code_source, names))
+    return rename_code(code, filename, name, qualname)
+
+
+def closure_cells(func):
+    """The closure cells of a function, by name of free variable."""
+    return dict(zip(func.__code__.co_freevars, func.__closure__))
+
+
+def set_cell(cell, value):
+    """Change the value of a closure cell."""
+    cell.cell_contents = value
+
+
+if sys.version_info < (3, 7):  # pragma: no cover
+
+    def _set_cell_code():
+        value = None
+
+        def set_value(new):
+            nonlocal value
+            value = new
+
+        return set_value.__code__
+
+    _set_cell_code = _set_cell_code()
+
+    def set_cell(cell, value):  # noqa: F811
+        """Change the value of a closure cell."""
+        # cell_contents is read-only before Python 3.7, so the value is
+        # assigned by a function that has the cell as its closure.
+        FunctionType(_set_cell_code, {}, None, None, (cell,))(value)
@@ -0,0 +1,436 @@
+"""Opt-in instrumentation of dispatch functions.
+
+Instrumentation is compiled into the generated dispatch function when
+it is defined, so dispatch functions defined while it is disabled
+don't pay for it at all. Set the ``REG_METRICS``,
+``REG_KEY_HISTOGRAM`` and ``REG_SLOW_LOOKUP_NS`` environment variables
+to enable it before any dispatch function is defined.
+"""
+
+import logging
+import os
+import warnings
+import weakref
+from collections import deque, namedtuple
+from functools import reduce
+from operator import mul
+
+try:
+    from time import perf_counter_ns
+except ImportError:  # pragma: no cover
+    # Python 3.6
+    from time import perf_counter
+
+    def perf_counter_ns():
+        """:func:`time.perf_counter` in nanoseconds."""
+        return int(perf_counter() * 1000000000)
+
+
+logger = logging.getLogger("reg")
+
+_metrics_enabled = bool(os.environ.get("REG_METRICS"))
+_collected = weakref.WeakSet()
+# from REG_KEY_HISTOGRAM, when first needed
+_key_histograms_size = None
+# from REG_SLOW_LOOKUP_NS, when first needed
+_slow_lookup_threshold = None
+_slow_lookups = deque(maxlen=1000)
+
+
+class CallMetrics(object):
+    """Call counters and timings of a single dispatch function.
+
+    All timings are in nanoseconds, as measured by
+    :func:`time.perf_counter_ns`, or by :func:`time.perf_counter` on
+    Python 3.6.
+
+    :param name: dotted name of the dispatch function.
+    """
+
+    __slots__ = (
+        "name",
+        "calls",
+        "key_ns",
+        "lookup_ns",
+        "call_ns",
+        "__weakref__",
+    )
+
+    def __init__(self, name):
+        self.name = name
+        self.reset()
+
+    def reset(self):
+        """Reset all counters to zero."""
+        self.calls = 0
+        self.key_ns = 0
+        self.lookup_ns = 0
+        self.call_ns = 0
+
+    def record(self, start, keyed, looked_up, end):
+        """Record a single call.
+
+        :param start: time at which the call started.
+        :param keyed: time at which the dispatch key was computed.
+        :param looked_up: time at which the implementation was found.
+        :param end: time at which the implementation returned.
+        """
+        self.calls += 1
+        self.key_ns += keyed - start
+        self.lookup_ns += looked_up - keyed
+        self.call_ns += end - looked_up
+
+
+def enable_metrics():
+    """Instrument dispatch functions defined from now on."""
+    global _metrics_enabled
+    _metrics_enabled = True
+
+
+def disable_metrics():
+    """Stop instrumenting dispatch functions defined from now on.
+
+    Dispatch functions that are already instrumented keep on
+    collecting metrics.
+    """
+    global _metrics_enabled
+    _metrics_enabled = False
+
+
+def metrics_enabled():
+    """Tell whether newly defined dispatch functions are instrumented."""
+    return _metrics_enabled
+
+
+def call_metrics(name):
+    """Create the :class:`CallMetrics` of an instrumented dispatch function.
+
+    :param name: dotted name of the dispatch function.
+    :returns: a :class:`CallMetrics` instance, taken into account by
+      :func:`metrics` for as long as it is alive.
+    """
+    result = CallMetrics(name)
+    _collected.add(result)
+    return result
+
+
+def metrics():
+    """Aggregated metrics of all instrumented dispatch functions.
+
+    Dispatch functions sharing the same name, such as the dispatch
+    methods of a class and its subclasses, are aggregated together.
+
+    :returns: a dictionary mapping the dotted names of the dispatch
+      functions to dictionaries with ``calls``, ``key_ns``,
+      ``lookup_ns`` and ``call_ns`` entries.
+    """
+    result = {}
+    for m in list(_collected):
+        totals = result.setdefault(
+            m.name, dict(calls=0, key_ns=0, lookup_ns=0, call_ns=0)
+        )
+        totals["calls"] += m.calls
+        totals["key_ns"] += m.key_ns
+        totals["lookup_ns"] += m.lookup_ns
+        totals["call_ns"] += m.call_ns
+    return result
+
+
+def reset_metrics():
+    """Reset the metrics of all instrumented dispatch functions."""
+    for m in list(_collected):
+        m.reset()
+
+
+class KeyHistogram(object):
+    """Bounded frequency count of dispatch keys.
+
+    This is a space-saving sketch: it tracks at most ``size`` keys.
+    When a new key comes in while it is full, it replaces the least
+    frequent key, and inherits its count. Counts of keys that came in
+    this way are overestimated by at most their ``error``, which is
+    the count they inherited.
+
+    Keys are also kept in buckets by count, as in the stream-summary
+    structure of the algorithm, so that recording a key takes
+    constant time however large the sketch is.
+
+    :param size: the maximum number of keys tracked.
+    """
+
+    __slots__ = (
+        "size",
+        "calls",
+        "counts",
+        "errors",
+        "buckets",
+        "minimum",
+        "floor",
+    )
+
+    def __init__(self, size):
+        self.size = size
+        self.calls = 0
+        self.counts = {}
+        self.errors = {}
+        # the keys with each count, in the order they got it
+        self.buckets = {}
+        # the lowest count of a key
+        self.minimum = 0
+        # the highest count of a replaced key
+        self.floor = 0
+
+    def add(self, key):
+        """Record a call with ``key``."""
+        self.calls += 1
+        counts = self.counts
+        buckets = self.buckets
+        count = counts.get(key)
+        if count is not None:
+            self._leave(key, count)
+        elif len(counts) < self.size:
+            count = 0
+            self.errors[key] = 0
+            self.minimum = 1
+        else:
+            count = self.minimum
+            # the last key to get the lowest count, as the others have
+            # been there longer and are more likely to come again
+            bucket = buckets[count]
+            replaced = bucket.popitem()[0]
+            if not bucket:
+                del buckets[count]
+                self.minimum = count + 1
+            del counts[replaced]
+            del self.errors[replaced]
+            self.errors[key] = count
+            self.floor = max(self.floor, count)
+        count += 1
+        counts[key] = count
+        bucket = buckets.get(count)
+        if bucket is None:
+            bucket = buckets[count] = {}
+        bucket[key] = None
+
+    def _leave(self, key, count):
+        # take key out of the bucket for count
+        bucket = self.buckets[count]
+        del bucket[key]
+        if not bucket:
+            del self.buckets[count]
+            if count == self.minimum:
+                # the key was the last with the lowest count, and
+                # is about to get the next one
+                self.minimum = count + 1
+
+    @property
+    def complete(self):
+        """``True`` if no key was ever dropped, so all counts are exact."""
+        return self.floor == 0
+
+    @property
+    def distinct(self):
+        """Number of distinct keys, or a lower bound if not :attr:`complete`."""
+        return len(self.counts)
+
+    def top(self, n=None):
+        """The most frequent keys.
+
+        :param n: the number of keys to return, or ``None`` to return
+          all tracked keys.
+        :returns: a list of ``(key, count, error)`` tuples, most
+          frequent first.
+        """
+        ranked = sorted(
+            self.counts.items(), key=lambda item: item[1], reverse=True
+        )
+        return [(key, count, self.errors[key]) for key, count in ranked[:n]]
+
+
+def enable_key_histograms(size=64):
+    """Sample the keys of dispatch functions defined from now on.
+
+    The histogram of a dispatch function is returned by
+    :meth:`reg.Dispatch.key_histogram`.
+
+    :param size: the maximum number of distinct keys tracked by each
+      dispatch function.
+    """
+    global _key_histograms_size
+    _key_histograms_size = size
+
+
+def disable_key_histograms():
+    """Stop sampling the keys of dispatch functions defined from now on."""
+    global _key_histograms_size
+    _key_histograms_size = 0
+
+
+def key_histograms_size():
+    """Size of the key histograms of newly defined dispatch functions.
+
+    Unless set with :func:`enable_key_histograms`, this is taken from
+    the ``REG_KEY_HISTOGRAM`` environment variable, which is ignored
+    with a warning if it isn't a number of keys.
+
+    :returns: the maximum number of keys tracked, or ``0`` if keys
+      aren't sampled.
+    """
+    global _key_histograms_size
+    if _key_histograms_size is None:
+        _key_histograms_size = _number_from_environ(
+            "REG_KEY_HISTOGRAM", "a number of keys"
+        )
+    return _key_histograms_size
+
+
+def _number_from_environ(name, description):
+    # The number in an environment variable, or 0 if it isn't set or
+    # isn't a number: reg can't fail to import because of it.
+    value = os.environ.get(name) or "0"
+    try:
+        result = int(value)
+    except ValueError:
+        result = -1
+    if result < 0:
+        warnings.warn(
+            "Ignoring %s=%r, which is not %s" % (name, value, description)
+        )
+        result = 0
+    return result
+
+
+class SlowLookup(
+    namedtuple("SlowLookup", "name method key duration_ns permutations")
+):
+    """A lookup that took longer than the slow lookup threshold.
+
+    :param name: dotted name of the dispatch function.
+    :param method: the key lookup method: ``"component"``,
+      ``"fallback"`` or ``"all"``.
+    :param key: the dispatch key looked up.
+    :param duration_ns: how long the lookup took, in nanoseconds.
+    :param permutations: the number of candidate keys the lookup
+      had to consider.
+    """
+
+    __slots__ = ()
+
+
+def enable_slow_lookups(threshold_ns=1000000):
+    """Watch uncached lookups of dispatch functions defined from now on.
+
+    Lookups in the :class:`reg.PredicateRegistry` that take longer
+    than ``threshold_ns`` are logged as warnings to the ``reg`` logger
+    and returned by :func:`slow_lookups`. Caching key lookups only
+    reach the registry on a cache miss, so only misses are timed.
+    They look up the ``component`` of a key in the matches they get
+    from ``all``, so their slow misses are reported as ``all``
+    lookups, whichever method was called.
+
+    Dispatch functions that are cleaned or get new predicates also
+    start to be watched.
+
+    :param threshold_ns: the duration above which a lookup is slow,
+      in nanoseconds.
+    """
+    global _slow_lookup_threshold
+    _slow_lookup_threshold = threshold_ns
+
+
+def disable_slow_lookups():
+    """Stop watching the lookups of dispatch functions defined from now on."""
+    global _slow_lookup_threshold
+    _slow_lookup_threshold = 0
+
+
+def slow_lookup_threshold():
+    """Slow lookup threshold of newly defined dispatch functions.
+
+    Unless set with :func:`enable_slow_lookups`, this is taken from
+    the ``REG_SLOW_LOOKUP_NS`` environment variable, which is ignored
+    with a warning if it isn't a number of nanoseconds.
+
+    :returns: the threshold in nanoseconds, or ``0`` if lookups
+      aren't watched.
+    """
+    global _slow_lookup_threshold
+    if _slow_lookup_threshold is None:
+        _slow_lookup_threshold = _number_from_environ(
+            "REG_SLOW_LOOKUP_NS", "a number of nanoseconds"
+        )
+    return _slow_lookup_threshold
+
+
+def slow_lookups():
+    """The most recent slow lookups.
+
+    :returns: a list of :class:`SlowLookup`, oldest first.
+    """
+    return list(_slow_lookups)
+
+
+def clear_slow_lookups():
+    """Forget about the slow lookups recorded so far."""
+    _slow_lookups.clear()
+
+
+class WatchedKeyLookup(object):
+    """A key lookup that reports slow lookups.
+
+    Wraps a :class:`reg.PredicateRegistry`, timing its ``component``,
+    ``fallback`` and ``all`` methods.
+
+    :param key_lookup: the :class:`reg.PredicateRegistry` to watch.
+    :param name: dotted name of the dispatch function.
+    :param threshold_ns: the duration above which a lookup is slow,
+      in nanoseconds.
+    """
+
+    def __init__(self, key_lookup, name, threshold_ns):
+        self.key_lookup = key_lookup
+        self.name = name
+        self.threshold_ns = threshold_ns
+
+    def __getattr__(self, name):
+        return getattr(self.key_lookup, name)
+
+    def component(self, key):
+        start = perf_counter_ns()
+        result = self.key_lookup.component(key)
+        self.watch("component", key, perf_counter_ns() - start)
+        return result
+
+    def fallback(self, key):
+        start = perf_counter_ns()
+        result = self.key_lookup.fallback(key)
+        self.watch("fallback", key, perf_counter_ns() - start)
+        return result
+
+    def all(self, key):
+        start = perf_counter_ns()
+        result = list(self.key_lookup.all(key))
+        self.watch("all", key, perf_counter_ns() - start)
+        return iter(result)
+
+    def watch(self, method, key, duration_ns):
+        if duration_ns <= self.threshold_ns:
+            return
+        permutations = reduce(
+            mul,
+            (
+                len(tuple(index.permutations(k)))
+                for index, k in zip(self.key_lookup.indexes, key)
+            ),
+            1,
+        )
+        event = SlowLookup(self.name, method, key, duration_ns, permutations)
+        _slow_lookups.append(event)
+        logger.warning(
+            "Slow %s lookup in %s for key %r: %.3f ms over %d permutations",
+            method,
+            self.name,
+            key,
+            duration_ns / 1000000,
+            permutations,
+        )
@@ -1,4 +1,4 @@
-import inspect
+from collections import OrderedDict
 from operator import itemgetter
 from itertools import product
 
@@ -22,15 +22,28 @@ class Predicate(object):
     :param default: default expected value of the predicate, to be
       used by :meth:`reg.Dispatch.register` whenever the expected
       value for the predicate is not given explicitly.
+    :param inline_key: optional Python expression equivalent to
+      ``get_key``, with ``{}`` standing for the argument named after
+      the predicate. Generated dispatch functions use it to check keys
+      without calling ``get_key``.
 
     """
 
-    def __init__(self, name, index, get_key=None, fallback=None, default=None):
+    def __init__(
+        self,
+        name,
+        index,
+        get_key=None,
+        fallback=None,
+        default=None,
+        inline_key=None,
+    ):
         self.name = name
         self.index = index
         self.fallback = fallback
         self.get_key = get_key
         self.default = default
+        self.inline_key = inline_key
 
     def create_index(self):
         return self.index(self.fallback)
@@ -56,9 +69,11 @@ def match_key(name, func=None, fallback=None, default=None):
     """
     if func is None:
         get_key = itemgetter(name)
+        inline_key = "{}"
     else:
         get_key = lambda d: func(**d)
-    return Predicate(name, KeyIndex, get_key, fallback, default)
+        inline_key = None
+    return Predicate(name, KeyIndex, get_key, fallback, default, inline_key)
 
 
 def match_instance(name, func=None, fallback=None, default=None):
@@ -77,9 +92,11 @@ def match_instance(name, func=None, fallback=None, default=None):
     """
     if func is None:
         get_key = lambda d: d[name].__class__
+        inline_key = "{}.__class__"
     else:
         get_key = lambda d: func(**d).__class__
-    return Predicate(name, ClassIndex, get_key, fallback, default)
+        inline_key = None
+    return Predicate(name, ClassIndex, get_key, fallback, default, inline_key)
 
 
 def match_class(name, func=None, fallback=None, default=None):
@@ -98,49 +115,215 @@ def match_class(name, func=None, fallback=None, default=None):
     """
     if func is None:
         get_key = itemgetter(name)
+        inline_key = "{}"
     else:
         get_key = lambda d: func(**d)
-    return Predicate(name, ClassIndex, get_key, fallback, default)
+        inline_key = None
+    return Predicate(name, ClassIndex, get_key, fallback, default, inline_key)
 
 
 _emptyset = frozenset()
 
 
+# Indexes store a single value as a tuple of one, which takes a lot
+# less memory than a set. These work with either, and with the same
+# interned values on both sides.
+
+
+def _disjoint(values, other):
+    if type(values) is tuple:
+        return values[0] not in other
+    if type(other) is tuple:
+        return other[0] not in values
+    return values.isdisjoint(other)
+
+
+def _intersection(values, other):
+    if values is other:
+        return values
+    if type(values) is tuple:
+        return values if values[0] in other else _emptyset
+    if type(other) is tuple:
+        return other if other[0] in values else _emptyset
+    return values.intersection(other)
+
+
+# how many keys an index remembers the first match of, evicting the
+# oldest first
+FIRST_MATCH_CACHE_SIZE = 1000
+
+# remembered for keys without a first match
+_nomatch = object()
+
+# how many values an index entry can have and still be interned
+INTERN_SIZE = 8
+
+
 class KeyIndex(dict):
     def __init__(self, fallback=None):
         self.fallback = fallback
+        # the first permutation with values of keys looked up
+        self.first_matches = OrderedDict()
+        self.interned = {}
 
     def __missing__(self, key):
         return _emptyset
 
+    def add(self, key, value):
+        """Add a value to the values for a key.
+
+        Most keys only get a single value, which is stored as a tuple
+        of one. Up to ``INTERN_SIZE`` values are stored as a
+        frozenset, which is replaced when the key gets another value.
+        Those are interned in ``interned``, so that keys with the same
+        values share them. Keys with more values get a set of their
+        own.
+        """
+        previous = dict.get(self, key)
+        if previous is None:
+            values = (value,)
+        elif value in previous:
+            return
+        elif type(previous) is set:
+            previous.add(value)
+            return
+        elif len(previous) < INTERN_SIZE:
+            values = self.intern(frozenset(previous).union((value,)))
+        else:
+            values = set(previous)
+            values.add(value)
+        if type(previous) is frozenset:
+            self.release(previous)
+        self[key] = values
+        self.matched(key, previous is None)
+
+    def add_all(self, key, values):
+        """Add values to the values for a key.
+
+        This stores them as :meth:`add` would, at once.
+        """
+        previous = dict.get(self, key)
+        if previous is None:
+            added = set(values)
+        else:
+            added = set(previous).union(values)
+            if len(added) == len(previous):
+                return
+            if type(previous) is set:
+                previous.update(added)
+                return
+        if len(added) == 1:
+            values = tuple(added)
+        elif len(added) <= INTERN_SIZE:
+            values = self.intern(frozenset(added))
+        else:
+            values = added
+        if type(previous) is frozenset:
+            self.release(previous)
+        self[key] = values
+        self.matched(key, previous is None)
+
+    def matched(self, key, new):
+        """Update the first matches once key has new values.
+
+        Keys remembered with a first match that comes after a new key
+        in their permutations now match it first, and keys that match
+        key get its new values.
+
+        :param key: the key.
+        :param new: whether key had no values before.
+        """
+        first_matches = self.first_matches
+        values = self[key]
+        for k, (match, previous) in list(first_matches.items()):
+            if match is not _nomatch and match == key:
+                first_matches[k] = (key, values)
+            elif new:
+                permutations = tuple(self.permutations(k))
+                if key in permutations and (
+                    match is _nomatch
+                    or permutations.index(key) < permutations.index(match)
+                ):
+                    first_matches[k] = (key, values)
+
+    def intern(self, values):
+        """The interned frozenset equal to values.
+
+        ``interned`` maps each interned frozenset to a list of it and
+        of the number of keys that use it.
+        """
+        entry = self.interned.get(values)
+        if entry is None:
+            entry = self.interned[values] = [values, 0]
+        entry[1] += 1
+        return entry[0]
+
+    def release(self, values):
+        """Drop an interned frozenset once no key uses it anymore."""
+        entry = self.interned[values]
+        entry[1] -= 1
+        if not entry[1]:
+            del self.interned[values]
+
+    def first_match(self, key):
+        """The values for the first permutation of key that has any.
+
+        Which permutation that is only depends on which keys have
+        values, so it is remembered along with its values, and updated
+        by :meth:`matched` when a key gets values.
+
+        :returns: the values, or ``None`` if no permutation has any.
+        """
+        first_matches = self.first_matches
+        try:
+            return first_matches[key][1]
+        except KeyError:
+            pass
+        for match in self.permutations(key):
+            if match in self:
+                result = self[match]
+                break
+        else:
+            match = _nomatch
+            result = None
+        if len(first_matches) >= FIRST_MATCH_CACHE_SIZE:
+            first_matches.popitem(last=False)
+        first_matches[key] = (match, result)
+        return result
+
     def permutations(self, key):
         """Permutations for a simple immutable key.
 
         There is only a single permutation: the key itself.
         """
-        yield key
+        return (key,)
 
 
 class ClassIndex(KeyIndex):
     def permutations(self, key):
         """Permutations for class key.
 
-        Returns class and its base classes in mro order. If a classic
-        class in Python 2, smuggle in ``object`` as the base class
-        anyway to make lookups consistent.
+        Returns class and its base classes in mro order. This is the
+        ``__mro__`` tuple that Python computes once for each class, and
+        which goes away with it.
         """
-        for class_ in inspect.getmro(key):
-            yield class_
-        if class_ is not object:
-            yield object  # pragma: no cover
+        return key.__mro__
 
 
 class PredicateRegistry(object):
     def __init__(self, *predicates):
+        self.listeners = []
+        # incremented by each registration
+        self.generation = 0
         self.known_keys = set()
+        self.exact = {}
         self.known_values = set()
         self.predicates = predicates
         self.indexes = [predicate.create_index() for predicate in predicates]
+        # the indexes share their interned values
+        self.interned = {}
+        for index in self.indexes:
+            index.interned = self.interned
         key_getters = [p.get_key for p in predicates]
         if len(predicates) == 0:
             self.key = lambda **kw: ()
@@ -162,21 +345,69 @@ class PredicateRegistry(object):
                 "Already have registration for key: %s" % (key,)
             )
         for index, key_item in zip(self.indexes, key):
-            index.setdefault(key_item, set()).add(value)
+            index.add(key_item, value)
         self.known_keys.add(key)
         self.known_values.add(value)
+        self.exact[key] = value
+        self.generation += 1
+        for listener in self.listeners:
+            listener()
+
+    def register_all(self, registrations):
+        """Register values for many keys at once.
+
+        This is the same as calling :meth:`register` for each, but
+        fills each index in one go, and notifies the listeners once.
+
+        :param registrations: an iterable of ``(key, value)`` tuples.
+        """
+        registrations = list(registrations)
+        keys = set()
+        for key, value in registrations:
+            if key in self.known_keys or key in keys:
+                raise RegistrationError(
+                    "Already have registration for key: %s" % (key,)
+                )
+            keys.add(key)
+        if not registrations:
+            return
+        for i, index in enumerate(self.indexes):
+            values_by_key = {}
+            for key, value in registrations:
+                values_by_key.setdefault(key[i], []).append(value)
+            for key_item, values in values_by_key.items():
+                index.add_all(key_item, values)
+        self.known_keys.update(keys)
+        self.known_values.update(value for key, value in registrations)
+        self.exact.update(registrations)
+        self.generation += 1
+        for listener in self.listeners:
+            listener()
 
     def get(self, keys):
-        # do an intersection of all sets that result from index lookup
-        # this code is a bit convoluted for performance reasons.
-        sets = (index[key] for index, key in zip(self.indexes, keys))
-        # besides doing the intersection,
-        # this returns the known values if there are no indexes at all
-        return next(sets, self.known_values).intersection(*sets)
+        # do an intersection of all sets that result from index lookup,
+        # starting with the smallest one so that each step only goes
+        # through the values left so far.
+        sets = [index[key] for index, key in zip(self.indexes, keys)]
+        if not sets:
+            # there are no indexes at all
+            return self.known_values.intersection()
+        sets.sort(key=len)
+        smallest = sets[0]
+        if type(smallest) is tuple:
+            # a single value, which only has to be in the other sets
+            value = smallest[0]
+            for values in sets[1:]:
+                if value not in values:
+                    return _emptyset
+            return smallest
+        if not smallest:
+            return _emptyset
+        return smallest.intersection(*sets[1:])
 
     def permutations(self, keys):
         return product(
-            *(index.permutations(key) for index, key in zip(self.indexes, keys))
+            *[index.permutations(key) for index, key in zip(self.indexes, keys)]
         )
 
     def key(self, **kw):
@@ -203,28 +434,111 @@ class PredicateRegistry(object):
         return tuple([p.key_by_predicate_name(d) for p in self.predicates])
 
     def component(self, keys):
-        return next(self.all(keys), None)
+        # An implementation registered for exactly this key is always
+        # the first match.
+        result = self.exact.get(keys)
+        if result is not None:
+            return result
+        # Otherwise we look for the first candidate that all returns,
+        # without going through all of them: as soon as the
+        # registrations for the keys of a candidate so far have nothing
+        # in common, we skip all the candidates that start with them.
+        candidates = []
+        for index, key in zip(self.indexes, keys):
+            present = [k for k in index.permutations(key) if k in index]
+            if not present:
+                return None
+            candidates.append(present)
+        if not candidates:
+            return next(iter(self.get(())), None)
+        # the number of candidates left to check below each depth
+        below = [1]
+        for present in reversed(candidates[1:]):
+            below.append(below[-1] * len(present))
+        below.reverse()
+        return self._first_match(candidates, below, 0, (), None)
+
+    def _first_match(self, candidates, below, depth, prefix, smallest):
+        # Intersecting the registrations of each prefix can be as
+        # expensive as a lookup when several predicates are broad, so
+        # we only check that the smallest set so far shares values
+        # with the next one, and only when this is cheaper than
+        # checking the candidates it would skip. Candidates that are
+        # left are then checked for real, with the smallest sets first.
+        index = self.indexes[depth]
+        if depth == len(candidates) - 1:
+            for k in candidates[depth]:
+                if smallest is None or not _disjoint(smallest, index[k]):
+                    p = prefix + (k,)
+                    values = self.get(p)
+                    if values:
+                        return self._first_value(p, values)
+            return None
+        for k in candidates[depth]:
+            values = index[k]
+            if smallest is not None:
+                if len(smallest) <= len(values):
+                    other, values = values, smallest
+                else:
+                    other = smallest
+                if len(values) <= below[depth] and _disjoint(values, other):
+                    continue
+            match = self._first_match(
+                candidates, below, depth + 1, prefix + (k,), values
+            )
+            if match is not None:
+                return match
+        return None
 
     def fallback(self, keys):
         result = None
         for index, key in zip(self.indexes, keys):
-            for k in index.permutations(key):
-                match = index[k]
-                if match:
-                    break
-            else:
+            match = index.first_match(key)
+            if match is None:
                 # no matching permutation for this key, so this is the fallback
                 return index.fallback
             if result is None:
                 result = match
             else:
-                result = result.intersection(match)
+                result = _intersection(result, match)
             # as soon as the intersection becomes empty, we have a failed
             # match
             if not result:
                 return index.fallback
 
+    def candidates(self, keys):
+        """The permutations of keys that can have registrations.
+
+        These are the permutations in the same order as
+        :meth:`permutations`, but leaving out those that have a key
+        without any registration in its index.
+        """
+        return product(
+            *[
+                [k for k in index.permutations(key) if k in index]
+                for index, key in zip(self.indexes, keys)
+            ]
+        )
+
+    def _first_value(self, p, values):
+        # Values registered for several keys can match a candidate
+        # they aren't registered for, along with the one that is: that
+        # one comes first, so that component and the first of all
+        # agree with the exact match of a registered key.
+        result = self.exact.get(p)
+        if result is not None:
+            return result
+        return next(iter(values))
+
     def all(self, key):
-        for p in self.permutations(key):
-            for value in self.get(p):
-                yield value
+        exact = self.exact
+        for p in self.candidates(key):
+            values = self.get(p)
+            if not values:
+                continue
+            first = exact.get(p)
+            if first is not None:
+                yield first
+            for value in values:
+                if value is not first:
+                    yield value
@@ -0,0 +1,44 @@
+"Sample application for testing ahead-of-time compilation."
+
+from reg import dispatch, match_instance, match_key
+
+
+class Document(object):
+    pass
+
+
+class Report(Document):
+    pass
+
+
+@dispatch(match_instance("obj"), match_key("name"))
+def view(obj, name):
+    return "default"
+
+
+@dispatch("obj")
+def title(obj):
+    return "untitled"
+
+
+def edit_document(obj, name):
+    return "edit document"
+
+
+def edit_report(obj, name):
+    return "edit report"
+
+
+def report_title(obj):
+    return "report"
+
+
+def configure():
+    view.register(edit_document, obj=Document, name="edit")
+    view.register(edit_report, obj=Report, name="edit")
+    title.register(report_title, obj=Report)
+
+
+def configure_locally():
+    # can't be referenced by name, so title isn't compiled
+    title.register(lambda obj: "document", obj=Document)
@@ -0,0 +1,5 @@
+"Sample configuration for testing ahead-of-time compilation."
+
+from . import compiled_app
+
+compiled_app.configure()
@@ -0,0 +1,6 @@
+"Sample configuration that can only partly be compiled ahead of time."
+
+from . import compiled_app
+
+compiled_app.configure()
+compiled_app.configure_locally()
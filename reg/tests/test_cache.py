@@ -0,0 +1,343 @@
+import gc
+import warnings
+
+from ..cache import (
+    LruCache,
+    TwoQueueCache,
+    ArcCache,
+    LruCachingKeyLookup,
+    PolicyCachingKeyLookup,
+    CacheBudget,
+    set_cache_budget,
+    cache_budget,
+    key_lookup_from_spec,
+)
+from ..dispatch import dispatch
+from ..predicate import PredicateRegistry, match_key
+import pytest
+
+
+class Counter(object):
+    def __init__(self):
+        self.computed = []
+
+    def __call__(self, key):
+        self.computed.append(key)
+        return key * 2
+
+
+@pytest.mark.parametrize("policy", [LruCache, TwoQueueCache, ArcCache])
+def test_policy_cache(policy):
+    func = Counter()
+    cache = policy(func, 10)
+
+    for i in range(100):
+        assert cache[i % 30] == (i % 30) * 2
+        assert len(cache) <= 10
+    assert len(func.computed) > 30
+
+
+@pytest.mark.parametrize("policy", [LruCache, TwoQueueCache, ArcCache])
+def test_policy_cache_hits(policy):
+    func = Counter()
+    cache = policy(func, 10)
+
+    for i in range(3):
+        for key in range(5):
+            assert cache[key] == key * 2
+    assert func.computed == [0, 1, 2, 3, 4]
+    assert len(cache) == 5
+    assert 3 in cache
+    assert 5 not in cache
+
+
+@pytest.mark.parametrize(
+    "policy,survives",
+    [(LruCache, False), (TwoQueueCache, True), (ArcCache, True)],
+)
+def test_policy_cache_scan(policy, survives):
+    func = Counter()
+    cache = policy(func, 8)
+
+    # make hot keys frequent, among keys used only once
+    for i in range(10):
+        for key in range(4):
+            cache[key]
+        for key in range(4):
+            cache[1000 + i * 4 + key]
+    # scan through many keys once
+    for key in range(100, 200):
+        cache[key]
+
+    assert all(key in cache for key in range(4)) is survives
+
+
+def test_policy_cache_none():
+    cache = ArcCache(lambda key: None, 2)
+    assert cache[1] is None
+    assert cache[1] is None
+    assert 1 in cache
+
+
+def test_policy_caching_registry():
+    class Foo(object):
+        pass
+
+    @dispatch(
+        "obj",
+        get_key_lookup=lambda r: PolicyCachingKeyLookup(r, 10, 10, 10, "arc"),
+    )
+    def foo(obj):
+        return "default"
+
+    @foo.register(obj=Foo)
+    def foo_foo(obj):
+        return "foo"
+
+    assert foo(Foo()) == "foo"
+    assert foo(1) == "default"
+    assert foo.by_args(Foo()).all_matches == [foo_foo]
+    assert isinstance(foo.key_lookup.component.__self__, ArcCache)
+
+
+def test_policy_from_spec():
+    r = PredicateRegistry(match_key("a"))
+
+    lookup = key_lookup_from_spec("2q:10")(r)
+    assert isinstance(lookup.component.__self__, TwoQueueCache)
+    lookup = key_lookup_from_spec("arc:10")(r)
+    assert isinstance(lookup.component.__self__, ArcCache)
+    assert lookup.component.__self__.size == 10
+
+    with pytest.raises(ValueError):
+        key_lookup_from_spec("arc:many")
+
+
+@pytest.mark.parametrize("policy", [LruCache, TwoQueueCache, ArcCache])
+def test_policy_cache_resize(policy):
+    cache = policy(lambda key: key, 20)
+    for i in range(3):
+        for key in range(20):
+            cache[key]
+    assert len(cache) == 20
+    assert cache.hits == 40
+    assert cache.misses == 20
+
+    cache.resize(5)
+    assert len(cache) == 5
+    for key in range(100):
+        cache[key]
+    assert len(cache) == 5
+
+
+@pytest.mark.parametrize("policy", [TwoQueueCache, ArcCache])
+def test_policy_cache_size_zero(policy):
+    cache = policy(lambda key: key * 2, 0)
+    assert cache.size == 1
+    for key in range(10):
+        assert cache[key] == key * 2
+        assert cache[key] == key * 2
+    assert len(cache) == 1
+
+    cache.resize(0)
+    assert cache.size == 1
+    assert cache[20] == 40
+    assert len(cache) == 1
+
+
+def test_cache_budget():
+    budget = CacheBudget(entries=60, min_size=10, interval=50)
+    hot = LruCache(lambda key: key, 0)
+    scan = LruCache(lambda key: key, 0)
+    unused = LruCache(lambda key: key, 0)
+    budget.add(hot)
+    budget.add(scan)
+    budget.add(unused)
+    # the first cache gets it all, so the others get what's left
+    assert hot.size == 60
+    assert scan.size == unused.size == 1
+    # and the budget is shared again on the next miss
+    hot[0]
+    assert hot.size == scan.size == unused.size == 10
+
+    for i in range(5):
+        for key in range(20):
+            hot[key]
+        for key in range(20):
+            scan[i * 20 + key]
+
+    # the budget was rebalanced by hit rate, giving most to the cache
+    # that has hits, but no more than twice what it uses
+    assert hot.size == 40
+    assert scan.size == 10
+    assert unused.size == 10
+
+    del unused
+    budget.rebalance()
+    assert hot.size == 40
+    assert scan.size == 20
+
+
+def test_cache_budget_reserve():
+    budget = CacheBudget(entries=100, min_size=10)
+    fixed = LruCache(lambda key: key, 70)
+    budget.reserve(fixed, 70)
+    first = LruCache(lambda key: key, 0)
+    second = LruCache(lambda key: key, 0)
+    budget.add(first)
+    budget.add(second)
+    assert first.size == 30
+    assert second.size == 1
+
+    budget.rebalance()
+    assert first.size == second.size == 10
+
+    del fixed
+    budget.rebalance()
+    assert first.size == second.size == 10
+    assert budget.reserved_entries == 0
+
+
+def test_cache_budget_too_small():
+    budget = CacheBudget(entries=20, min_size=10)
+    caches = [LruCache(lambda key: key, 0) for i in range(4)]
+    for cache in caches:
+        budget.add(cache)
+    # caches have at least one entry
+    assert [cache.size for cache in caches] == [20, 1, 1, 1]
+
+    budget.rebalance()
+    assert [cache.size for cache in caches] == [5, 5, 5, 5]
+
+
+def test_cache_budget_bytes():
+    budget = CacheBudget(bytes=CacheBudget.ENTRY_BYTES * 50)
+    assert budget.entries == 50
+    with pytest.raises(ValueError):
+        CacheBudget()
+
+
+def test_budget_caching_registry():
+    previous = cache_budget()
+    try:
+        set_cache_budget(1000, interval=10)
+
+        @dispatch("obj", get_key_lookup=key_lookup_from_spec("arc"))
+        def foo(obj):
+            return "default"
+
+        component_cache = foo.key_lookup.component.__self__
+        assert component_cache.budget is cache_budget()
+        assert component_cache in cache_budget().caches
+
+        for i in range(10):
+            foo(type("Cls%s" % i, (object,), {})())
+        assert component_cache.size < 1000
+
+        set_cache_budget(500)
+        assert component_cache.budget is cache_budget()
+        assert component_cache.size <= 500
+    finally:
+        set_cache_budget(previous.entries)
+
+
+def test_sized_caching_registry_reserves_budget():
+    previous = cache_budget()
+    try:
+        # caches left over by other tests
+        gc.collect()
+        set_cache_budget(1000)
+        cache_budget().rebalance()
+        reserved = cache_budget().reserved_entries
+
+        r = PredicateRegistry(match_key("a"))
+        lru = LruCachingKeyLookup(r, 10, 20, 30)
+        policy = PolicyCachingKeyLookup(r, 10, 20, 30, "arc")
+        assert cache_budget().reserved_entries == reserved + 120
+        assert policy.component.__self__.budget is None
+
+        set_cache_budget(500)
+        assert cache_budget().reserved_entries == reserved + 120
+
+        del lru, policy
+        cache_budget().rebalance()
+        assert cache_budget().reserved_entries == reserved
+    finally:
+        set_cache_budget(previous.entries)
+
+
+class CountingRegistry(PredicateRegistry):
+    def __init__(self, *predicates):
+        super(CountingRegistry, self).__init__(*predicates)
+        self.lookups = []
+
+    def all(self, key):
+        self.lookups.append(key)
+        return super(CountingRegistry, self).all(key)
+
+
+@pytest.mark.parametrize(
+    "spec", ["dict", "lru:10", "2q:10", "arc:10", "adaptive:10"]
+)
+def test_caching_key_lookup_shares_matches(spec):
+    r = CountingRegistry(match_key("a"))
+    r.register(("x",), "x value")
+    key_lookup = key_lookup_from_spec(spec)(r)
+
+    assert key_lookup.component(("x",)) == "x value"
+    assert key_lookup.all(("x",)) == ("x value",)
+    assert key_lookup.component(("y",)) is None
+    assert key_lookup.all(("y",)) == ()
+    assert r.lookups == [("x",), ("y",)]
+
+
+@pytest.mark.parametrize(
+    "spec", ["dict", "lru:10", "2q:10", "arc:10", "adaptive:10"]
+)
+def test_caching_key_lookup_clear(spec):
+    r = CountingRegistry(match_key("a"))
+    r.register(("x",), "x value")
+    key_lookup = key_lookup_from_spec(spec)(r)
+
+    assert key_lookup.component(("x",)) == "x value"
+    assert key_lookup.fallback(("x",)) is None
+    assert key_lookup.cached_keys() == [("x",)]
+    key_lookup.clear()
+    assert list(key_lookup.cached_keys()) == []
+    assert key_lookup.component(("x",)) == "x value"
+    assert r.lookups == [("x",), ("x",)]
+
+
+def test_lru_caching_registry_clear_empty():
+    @dispatch(
+        match_key("name"),
+        get_key_lookup=lambda r: LruCachingKeyLookup(r, 100, 100, 100),
+    )
+    def view(name):
+        return "default"
+
+    # registering with empty caches leaves them alone, as clearing them
+    # allocates them again
+    cache = view.key_lookup.component._cache
+    clock_keys = cache.clock_keys
+    view.register(lambda name: "edit", name="edit")
+    assert cache.clock_keys is clock_keys
+
+    assert view.key_lookup.component(("edit",)) is not None
+    view.register(lambda name: "delete", name="delete")
+    assert cache.clock_keys is not clock_keys
+    assert view("delete") == "delete"
+
+
+@pytest.mark.parametrize(
+    "value, entries", [("", 100000), ("500", 500), ("lots", 100000)]
+)
+def test_cache_budget_from_environ(monkeypatch, value, entries):
+    monkeypatch.setattr("reg.cache._cache_budget", None)
+    monkeypatch.setenv("REG_CACHE_BUDGET", value)
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        # caches of a fixed size count against the budget
+        LruCachingKeyLookup(PredicateRegistry(match_key("a")), 10, 10, 10)
+    assert cache_budget().entries == entries
+    assert len(caught) == (value == "lots")
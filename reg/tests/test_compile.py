@@ -0,0 +1,183 @@
+import gc
+import importlib
+import sys
+
+import pytest
+
+from ..arginfo import arginfo
+from ..compile import (
+    load_code,
+    load_tables,
+    main,
+    reference,
+)
+from ..dispatch import dispatch, identity, _compiled, inner_code
+from ..error import RegistrationError
+from ..predicate import match_key
+
+APP = "reg.tests.fixtures.compiled_app"
+CONFIG = "reg.tests.fixtures.compiled_config"
+PARTIAL_CONFIG = "reg.tests.fixtures.compiled_partial_config"
+
+
+def forget(name):
+    sys.modules.pop(name, None)
+    package, _, attr = name.rpartition(".")
+    if package in sys.modules and hasattr(sys.modules[package], attr):
+        delattr(sys.modules[package], attr)
+
+
+def generate(config, tmp_path, monkeypatch):
+    monkeypatch.syspath_prepend(str(tmp_path))
+    # which code is generated depends on the default key lookup
+    monkeypatch.setattr(
+        sys.modules[dispatch.__module__], "_default_key_lookup", identity
+    )
+    forget(APP)
+    forget(config)
+    # dispatch functions left over by other tests would be compiled too
+    gc.collect()
+    main([config, "-o", str(tmp_path / "_reg_tables_test.py")])
+    forget(APP)
+    forget(config)
+    # the argument info cache would keep the dispatch functions alive
+    arginfo._cache.clear()
+    gc.collect()
+    yield importlib.import_module("_reg_tables_test")
+    forget("_reg_tables_test")
+    forget(APP)
+    _compiled.clear()
+    arginfo._cache.clear()
+    gc.collect()
+
+
+@pytest.fixture
+def generated(tmp_path, monkeypatch):
+    for module in generate(CONFIG, tmp_path, monkeypatch):
+        yield module
+
+
+@pytest.fixture
+def generated_partial(tmp_path, monkeypatch):
+    for module in generate(PARTIAL_CONFIG, tmp_path, monkeypatch):
+        yield module
+
+
+def test_reference():
+    assert reference(dispatch) == "reg.dispatch:dispatch"
+    assert reference(lambda: None) is None
+    assert reference(object()) is None
+
+
+def test_generated_module(generated):
+    assert generated.VERSION == 1
+    # for both signatures, predicate_key building its key inline or
+    # not, and call without, with one and with more registrations, for
+    # view with the inline cache
+    assert len(generated.CODE) == 11
+    for source, code in generated.CODE.items():
+        assert source.startswith("def ")
+        assert code.co_filename == generated.__file__
+
+    assert generated.TABLES == {
+        APP
+        + ".title": (
+            ("obj",),
+            [(({"class": APP + ":Report"},), APP + ":report_title")],
+        ),
+        APP
+        + ".view": (
+            ("obj", "name"),
+            [
+                (
+                    ({"class": APP + ":Document"}, ["edit"]),
+                    APP + ":edit_document",
+                ),
+                (
+                    ({"class": APP + ":Report"}, ["edit"]),
+                    APP + ":edit_report",
+                ),
+            ],
+        ),
+    }
+    assert generated.SKIPPED == []
+
+
+def test_load(generated):
+    assert load_code(generated) == 11
+
+    for source, code in generated.CODE.items():
+        assert _compiled[source] is inner_code(code)
+
+    app = importlib.import_module(APP)
+    assert app.view.__code__.co_filename == generated.__file__
+    assert app.view.__name__ == "view"
+    assert app.view(app.Report(), "edit") == "default"
+
+    assert load_tables(generated) == [APP + ".title", APP + ".view"]
+    # registered all at once
+    assert app.view.key_lookup.generation == 1
+
+    assert app.view(app.Report(), "edit") == "edit report"
+    assert app.view(app.Document(), "edit") == "edit document"
+    assert app.view(app.Document(), "delete") == "default"
+    assert app.title(app.Report()) == "report"
+    assert app.title(app.Document()) == "untitled"
+
+    # registrations are only restored once
+    assert load_tables(generated) == []
+
+
+def test_load_tables_mismatch(generated):
+    app = importlib.import_module(APP)
+    app.view.add_predicates([match_key("extra")])
+
+    assert load_tables(generated) == []
+    # nothing is restored, so that registering as usual works
+    assert app.title(app.Report()) == "untitled"
+    app.configure()
+
+
+def test_load_tables_unresolvable(generated):
+    generated.TABLES[APP + ".view"][1].append(
+        (({"class": "no.such.module:Gone"}, ["edit"]), APP + ":edit_report")
+    )
+    app = importlib.import_module(APP)
+
+    assert load_tables(generated) == []
+    assert app.title(app.Report()) == "untitled"
+
+
+def test_load_tables_signature(generated):
+    generated.TABLES[APP + ".title"][1].append(
+        (({"class": APP + ":Document"},), APP + ":edit_document")
+    )
+    app = importlib.import_module(APP)
+
+    with pytest.raises(RegistrationError):
+        load_tables(generated)
+    assert app.title(app.Report()) == "untitled"
+
+
+def test_load_tables_partial(generated_partial):
+    assert generated_partial.SKIPPED == [APP + ".title"]
+    assert list(generated_partial.TABLES) == [APP + ".view"]
+    app = importlib.import_module(APP)
+
+    with pytest.raises(RegistrationError):
+        load_tables(generated_partial)
+    assert app.view(app.Report(), "edit") == "default"
+
+
+def test_load_other_version(generated):
+    generated.VERSION = 0
+
+    assert load_code(generated) == 0
+    assert load_tables(generated) == []
+
+
+def test_main_stdout(capsys):
+    main(["reg.tests.fixtures.module"])
+
+    out = capsys.readouterr().out
+    assert '"""Dispatch functions compiled ahead of time' in out
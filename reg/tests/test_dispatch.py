@@ -1,9 +1,25 @@
 from __future__ import unicode_literals
+import dis
+
 import pytest
 
-from ..predicate import match_instance, match_key, match_class
-from ..dispatch import dispatch
+from ..predicate import (
+    Predicate,
+    KeyIndex,
+    match_instance,
+    match_key,
+    match_class,
+)
+from ..dispatch import (
+    dispatch,
+    identity,
+    default_key_lookup_from_environ,
+    LookupEntry,
+    _compiled,
+    closure_cells,
+)
 from ..error import RegistrationError
+from ..cache import DictCachingKeyLookup
 
 
 class IAlpha(object):
@@ -1117,3 +1133,403 @@ def test_predicate_key_wrong_keyword_argument_gives_typeerror():
 
     with pytest.raises(TypeError):
         assert foo.by_args(wrong=1)
+
+
+def test_generated_code_names():
+    @dispatch("obj")
+    def foo(obj):
+        pass
+
+    @dispatch("obj")
+    def bar(obj):
+        pass
+
+    assert foo.__code__.co_name == "foo"
+    assert foo.__code__.co_filename == (
+        "<dispatch reg.tests.test_dispatch."
+        "test_generated_code_names.<locals>.foo>"
+    )
+    assert foo.__code__.co_filename != bar.__code__.co_filename
+    predicate_key = foo.by_args.__self__._predicate_key
+    assert predicate_key.__code__.co_filename == foo.__code__.co_filename
+    assert predicate_key.__qualname__ == (
+        "test_generated_code_names.<locals>.foo.predicate_key"
+    )
+
+
+def test_generated_code_shared():
+    @dispatch("obj")
+    def foo(obj):
+        return "foo"
+
+    compiled = len(_compiled)
+
+    @dispatch("obj")
+    def bar(obj):
+        return "bar"
+
+    # bar has the same signature as foo, so nothing new was compiled
+    assert len(_compiled) == compiled
+    assert foo.__closure__ is not bar.__closure__
+    assert foo(None) == "foo"
+    assert bar(None) == "bar"
+
+
+def test_clean_leaves_globals_alone():
+    @dispatch("obj")
+    def foo(obj):
+        return "default"
+
+    foo.register(lambda obj: "int", obj=int)
+    before = dict(foo.__globals__)
+
+    foo.clean()
+    assert foo(1) == "default"
+    foo.register(lambda obj: "str", obj=str)
+    assert foo("a") == "str"
+
+    assert foo.__globals__ == before
+    assert "_component_lookup" in foo.__code__.co_freevars
+
+
+class CountingKeyLookup(object):
+    def __init__(self, registry):
+        self.registry = registry
+        self.lookups = 0
+
+    def component(self, key):
+        self.lookups += 1
+        return self.registry.component(key)
+
+    def fallback(self, key):
+        self.lookups += 1
+        return self.registry.fallback(key)
+
+    def all(self, key):
+        return self.registry.all(key)
+
+
+def loaded_names(func):
+    # the names the generated code of func actually loads
+    return {
+        instruction.argval
+        for instruction in dis.get_instructions(func)
+        if instruction.opname.startswith("LOAD_")
+    }
+
+
+def test_call_without_registrations():
+    @dispatch(
+        match_instance("obj", fallback=lambda obj: "fallback"),
+        get_key_lookup=identity,
+    )
+    def foo(obj):
+        return "default"
+
+    assert foo(1) == "fallback"
+    assert "_registry_key" not in loaded_names(foo)
+
+    @dispatch(get_key_lookup=identity)
+    def bar():
+        return "default"
+
+    assert bar() == "default"
+    assert "_registry_key" not in loaded_names(bar)
+
+
+def test_call_without_registrations_key_lookup():
+    # a key lookup of its own still sees the calls
+    @dispatch(
+        match_instance("obj", fallback=lambda obj: "fallback"),
+        get_key_lookup=CountingKeyLookup,
+    )
+    def foo(obj):
+        return "default"
+
+    assert foo(1) == "fallback"
+    assert foo.key_lookup.lookups == 2
+
+
+@pytest.mark.parametrize(
+    "get_key_lookup", [DictCachingKeyLookup, CountingKeyLookup]
+)
+def test_call_without_predicates_key_lookup(get_key_lookup):
+    @dispatch(get_key_lookup=get_key_lookup)
+    def foo():
+        return "default"
+
+    assert foo() == "default"
+    foo.register(lambda: "registered")
+    assert foo() == "registered"
+    assert foo() == "registered"
+
+
+def test_call_without_registrations_get_key():
+    # and so does the function computing a key
+    @dispatch(match_instance("obj", lambda obj: obj[0]))
+    def foo(obj):
+        return "default"
+
+    with pytest.raises(TypeError):
+        foo(1)
+
+
+def test_call_with_single_registration():
+    class Sub(Alpha):
+        pass
+
+    @dispatch(
+        match_instance("obj"),
+        match_key("name"),
+        get_key_lookup=CountingKeyLookup,
+    )
+    def foo(obj, name):
+        return "default"
+
+    call = foo
+    foo.register(lambda obj, name: "alpha", obj=Alpha, name="edit")
+
+    assert foo(Alpha(), "edit") == "alpha"
+    assert foo.key_lookup.lookups == 0
+    assert foo(Sub(), "edit") == "alpha"
+    assert foo(Alpha(), "view") == "default"
+    assert foo.key_lookup.lookups == 3
+
+    foo.register(lambda obj, name: "sub", obj=Sub, name="edit")
+    assert foo is call
+    assert foo(Sub(), "edit") == "sub"
+    assert foo(Alpha(), "edit") == "alpha"
+
+    foo.clean()
+    assert foo(Alpha(), "edit") == "default"
+
+    foo.register(lambda obj, name: "alpha", obj=Alpha, name="edit")
+    foo.add_predicates([match_key("extra", lambda obj, name: name)])
+    assert foo(Alpha(), "edit") == "default"
+
+
+def test_call_with_single_registration_computed_key():
+    @dispatch(
+        match_instance("obj", lambda obj: obj[0]),
+        get_key_lookup=CountingKeyLookup,
+    )
+    def foo(obj):
+        return "default"
+
+    foo.register(lambda obj: "alpha", obj=Alpha)
+
+    assert "_single_key" not in loaded_names(foo)
+    assert foo((Alpha(),)) == "alpha"
+    assert foo((Beta(),)) == "default"
+    assert foo.key_lookup.lookups == 3
+
+
+def test_call_inline_cache():
+    @dispatch(
+        match_instance("obj"),
+        match_key("name"),
+        get_key_lookup=CountingKeyLookup,
+    )
+    def foo(obj, name):
+        return "default"
+
+    foo.register(lambda obj, name: "alpha", obj=Alpha, name="edit")
+    foo.register(lambda obj, name: "beta", obj=Beta, name="edit")
+
+    for i in range(10):
+        assert foo(Alpha(), "edit") == "alpha"
+        assert foo(Beta(), "edit") == "beta"
+    assert foo.key_lookup.lookups == 2
+
+    assert foo(Alpha(), "view") == "default"
+    assert foo(Alpha(), "view") == "default"
+    assert foo.key_lookup.lookups == 4
+
+    # registering empties the inline cache
+    foo.register(lambda obj, name: "alpha view", obj=Alpha, name="view")
+    assert foo(Alpha(), "view") == "alpha view"
+    assert foo.key_lookup.lookups == 5
+
+    foo.clean()
+    assert foo(Alpha(), "edit") == "default"
+
+
+def test_call_megamorphic():
+    @dispatch(match_instance("obj"), get_key_lookup=CountingKeyLookup)
+    def foo(obj):
+        return "default"
+
+    classes = [type("Cls%s" % i, (object,), {}) for i in range(3)]
+    for cls in classes:
+        foo.register(lambda obj: "registered", obj=cls)
+
+    # cycling through three classes always misses the inline cache
+    for i in range(1000):
+        assert foo(classes[i % 3]()) == "registered"
+    assert foo.key_lookup.lookups == 1000
+
+    # so it is no longer used
+    assert foo(classes[2]()) == "registered"
+    assert foo(classes[2]()) == "registered"
+    assert foo.key_lookup.lookups == 1002
+
+
+def test_lookup_entry_remembers_resolution():
+    class Counting(CountingKeyLookup):
+        @property
+        def generation(self):
+            return self.registry.generation
+
+        def all(self, key):
+            self.lookups += 1
+            return self.registry.all(key)
+
+    @dispatch(
+        match_instance("obj", fallback=lambda obj: "fallback"),
+        get_key_lookup=Counting,
+    )
+    def foo(obj):
+        return "default"
+
+    def foo_str(obj):
+        return "str"
+
+    foo.register(foo_str, obj=str)
+    entry = foo.by_args("a")
+    assert foo.key_lookup.lookups == 0
+    assert entry.component is foo_str
+    assert entry.component is foo_str
+    assert entry.fallback is None
+    assert entry.fallback is None
+    assert entry.all_matches == [foo_str]
+    assert list(entry.matches) == [foo_str]
+    assert foo.key_lookup.lookups == 3
+
+    # a new entry looks up again
+    assert foo.by_args("b").component is foo_str
+    assert foo.key_lookup.lookups == 4
+
+    # registering looks up again
+    def foo_object(obj):
+        return "object"
+
+    foo.register(foo_object, obj=object)
+    assert entry.component is foo_str
+    assert entry.all_matches == [foo_str, foo_object]
+    assert foo.key_lookup.lookups == 6
+    assert foo.by_args(1).component is foo_object
+
+    # key lookups without a generation look up each time
+    entry = LookupEntry(CountingKeyLookup(foo.key_lookup.registry), (str,))
+    assert entry.component is foo_str
+    assert entry.component is foo_str
+    assert entry.lookup.lookups == 2
+
+
+def test_lookup_entry_tuple():
+    @dispatch("obj")
+    def foo(obj):
+        return "default"
+
+    entry = foo.by_args(1)
+    lookup, key = entry
+    assert lookup is foo.key_lookup
+    assert key == (int,)
+    assert entry == foo.by_args(2)
+    assert hash(entry) == hash(foo.by_args(2))
+    assert entry != foo.by_args("a")
+    assert entry == (lookup, key)
+    assert entry[0] is lookup
+    assert entry[1] == key
+    assert len({entry, foo.by_args(2), foo.by_args("a")}) == 2
+    assert repr(entry) == "LookupEntry(lookup=%r, key=(%r,))" % (lookup, int)
+    with pytest.raises(AttributeError):
+        entry.key = (str,)
+
+
+def test_predicate_key_inline():
+    def get_key(d):
+        raise AssertionError("key computed by the registry")
+
+    @dispatch(
+        match_instance("obj"),
+        Predicate("name", KeyIndex, get_key, inline_key="{}"),
+    )
+    def foo(obj, name, extra=None):
+        return "default"
+
+    assert foo.by_args(1, "a").key == (int, "a")
+    assert foo.by_args(obj=1, name="a", extra=2).key == (int, "a")
+
+    @dispatch(match_key("name", lambda obj, name: name.upper()))
+    def bar(obj, name):
+        return "default"
+
+    assert bar.by_args(1, "a").key == ("A",)
+
+    @dispatch()
+    def baz(obj):
+        return "default"
+
+    assert baz.by_args(1).key == ()
+
+
+def test_predicate_key_add_predicates():
+    @dispatch(match_key("name", lambda obj, name: name.upper()))
+    def foo(obj, name):
+        return "default"
+
+    assert foo.by_args(1, "a").key == ("A",)
+    foo.add_predicates([match_instance("obj")])
+    assert foo.by_args(1, "a").key == ("A", int)
+    foo.clean()
+    assert foo.by_args(1, "a").key == ("A",)
+
+
+def test_call_inline_cache_equal_keys():
+    @dispatch(
+        match_instance("obj"),
+        match_key("name"),
+        get_key_lookup=CountingKeyLookup,
+    )
+    def foo(obj, name):
+        return "default"
+
+    foo.register(lambda obj, name: "alpha", obj=Alpha, name="edit")
+    assert foo(Alpha(), "".join(["ed", "it"])) == "alpha"
+    foo.register(lambda obj, name: "beta", obj=Beta, name="edit")
+
+    # keys built at runtime are equal, not identical
+    for i in range(10):
+        assert foo(Alpha(), "".join(["ed", "it"])) == "alpha"
+        assert foo(Beta(), "".join(["ed", "it"])) == "beta"
+    assert foo.key_lookup.lookups == 2
+
+
+def test_call_inline_cache_is_replaced():
+    @dispatch(match_instance("obj"))
+    def foo(obj):
+        return "default"
+
+    foo.register(lambda obj: "alpha", obj=Alpha)
+    foo.register(lambda obj: "beta", obj=Beta)
+
+    cell = closure_cells(foo)["_inline_cache"]
+    before = cell.cell_contents
+    assert foo(Alpha()) == "alpha"
+    after = cell.cell_contents
+    assert isinstance(after, tuple)
+    assert after is not before
+    assert after[:2] == (Alpha, foo.by_args(Alpha()).component)
+    # the previous entry moves back
+    assert after[2:] == before[:2]
+
+
+def test_default_key_lookup_from_environ(monkeypatch):
+    monkeypatch.setenv("REG_KEY_LOOKUP", "dict")
+    assert default_key_lookup_from_environ() is DictCachingKeyLookup
+    monkeypatch.setenv("REG_KEY_LOOKUP", "")
+    assert default_key_lookup_from_environ() is identity
+    monkeypatch.setenv("REG_KEY_LOOKUP", "bogus")
+    with pytest.warns(UserWarning, match="REG_KEY_LOOKUP='bogus'"):
+        assert default_key_lookup_from_environ() is identity
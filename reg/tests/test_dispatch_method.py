@@ -542,6 +542,20 @@ def test_install_auto_method_method_app_arg():
     assert unmethodify(t.m) is g
 
 
+def test_methodify_code_names():
+    def f(a):
+        return a
+
+    wrapper = methodify(f)
+
+    assert wrapper.__code__.co_name == "f"
+    assert wrapper.__qualname__ == "test_methodify_code_names.<locals>.f"
+    assert wrapper.__code__.co_filename == (
+        "<methodify reg.tests.test_dispatch_method."
+        "test_methodify_code_names.<locals>.f>"
+    )
+
+
 def test_install_instance_method():
     class Target(object):
         pass
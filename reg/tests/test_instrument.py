@@ -0,0 +1,260 @@
+import warnings
+
+from ..dispatch import dispatch, identity
+from ..instrument import (
+    enable_metrics,
+    disable_metrics,
+    metrics_enabled,
+    metrics,
+    reset_metrics,
+    enable_key_histograms,
+    disable_key_histograms,
+    KeyHistogram,
+    key_histograms_size,
+    enable_slow_lookups,
+    disable_slow_lookups,
+    slow_lookups,
+    clear_slow_lookups,
+    slow_lookup_threshold,
+)
+from ..cache import DictCachingKeyLookup
+import pytest
+
+
+@pytest.fixture
+def instrumented():
+    enable_metrics()
+    yield
+    disable_metrics()
+
+
+def test_metrics_disabled_by_default():
+    assert not metrics_enabled()
+
+    @dispatch("obj")
+    def plain(obj):
+        return "default"
+
+    plain(1)
+    assert "_record" not in plain.__code__.co_freevars
+    assert not any(name.endswith(".plain") for name in metrics())
+
+
+def test_metrics(instrumented):
+    class Foo(object):
+        pass
+
+    @dispatch("obj")
+    def measured(obj):
+        return "default"
+
+    @measured.register(obj=Foo)
+    def measured_foo(obj):
+        return "foo"
+
+    assert measured(Foo()) == "foo"
+    assert measured(None) == "default"
+
+    name = measured.wrapped_func.__module__ + ".test_metrics.<locals>.measured"
+    result = metrics()[name]
+    assert result["calls"] == 2
+    assert result["key_ns"] >= 0
+    assert result["lookup_ns"] >= 0
+    assert result["call_ns"] >= 0
+
+    reset_metrics()
+    assert metrics()[name] == dict(calls=0, key_ns=0, lookup_ns=0, call_ns=0)
+
+
+def test_metrics_of_failing_call(instrumented):
+    @dispatch("obj")
+    def failing(obj):
+        raise ZeroDivisionError()
+
+    with pytest.raises(ZeroDivisionError):
+        failing(1)
+
+    (result,) = [v for k, v in metrics().items() if k.endswith(".failing")]
+    assert result["calls"] == 1
+
+
+def test_metrics_after_disable(instrumented):
+    @dispatch("obj")
+    def before(obj):
+        return "before"
+
+    disable_metrics()
+
+    @dispatch("obj")
+    def after(obj):
+        return "after"
+
+    before(1)
+    after(1)
+
+    names = [k.rpartition(".")[2] for k, v in metrics().items() if v["calls"]]
+    assert "before" in names
+    assert "after" not in names
+
+
+@pytest.fixture
+def sampled():
+    enable_key_histograms(4)
+    yield
+    disable_key_histograms()
+
+
+def test_key_histogram_disabled_by_default():
+    @dispatch("obj")
+    def plain(obj):
+        return "default"
+
+    plain(1)
+    assert plain.key_histogram() is None
+
+
+def test_key_histogram(sampled):
+    @dispatch("obj")
+    def sampled_func(obj):
+        return "default"
+
+    for i in range(3):
+        sampled_func(1)
+    sampled_func("a")
+
+    histogram = sampled_func.key_histogram()
+    assert histogram.calls == 4
+    assert histogram.complete
+    assert histogram.distinct == 2
+    assert histogram.top() == [((int,), 3, 0), ((str,), 1, 0)]
+    assert histogram.top(1) == [((int,), 3, 0)]
+
+
+def test_key_histogram_bounded():
+    histogram = KeyHistogram(4)
+    for i in range(10):
+        histogram.add("hot")
+    for key in "abcdefgh":
+        histogram.add(key)
+    histogram.add("h")
+
+    assert histogram.calls == 19
+    assert not histogram.complete
+    assert histogram.distinct == 4
+    # each new key replaced the last one to get the lowest count
+    assert histogram.top() == [
+        ("hot", 10, 0),
+        ("h", 4, 2),
+        ("g", 3, 2),
+        ("d", 2, 1),
+    ]
+    assert histogram.minimum == 2
+    assert histogram.buckets == {
+        2: {"d": None},
+        3: {"g": None},
+        4: {"h": None},
+        10: {"hot": None},
+    }
+
+
+@pytest.mark.parametrize(
+    "value, size", [("", 0), ("16", 16), ("many", 0), ("-1", 0)]
+)
+def test_key_histograms_size_from_environ(monkeypatch, value, size):
+    monkeypatch.setattr("reg.instrument._key_histograms_size", None)
+    monkeypatch.setenv("REG_KEY_HISTOGRAM", value)
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        assert key_histograms_size() == size
+        assert key_histograms_size() == size
+    assert len(caught) == (value in ("many", "-1"))
+
+
+def test_key_histogram_with_metrics(sampled, instrumented):
+    @dispatch("obj")
+    def both(obj):
+        return "default"
+
+    assert both(1) == "default"
+    assert both.key_histogram().calls == 1
+    (result,) = [v for k, v in metrics().items() if k.endswith(".both")]
+    assert result["calls"] == 1
+
+
+@pytest.fixture
+def watched():
+    enable_slow_lookups(threshold_ns=1)
+    yield
+    disable_slow_lookups()
+    clear_slow_lookups()
+
+
+def test_slow_lookups(watched, caplog):
+    class Base(object):
+        pass
+
+    class Sub(Base):
+        pass
+
+    @dispatch("a", "b", get_key_lookup=identity)
+    def slow(a, b):
+        return "default"
+
+    @slow.register(a=Base, b=Base)
+    def slow_base(a, b):
+        return "base"
+
+    assert slow(Sub(), Base()) == "base"
+    assert slow.by_args(Sub(), Sub()).all_matches == [slow_base]
+
+    events = slow_lookups()
+    assert [e.method for e in events] == ["component", "all"]
+    component, all = events
+    assert component.name.endswith(".test_slow_lookups.<locals>.slow")
+    assert component.key == (Sub, Base)
+    assert component.permutations == 6
+    assert component.duration_ns > 0
+    assert all.key == (Sub, Sub)
+    assert all.permutations == 9
+    assert "Slow component lookup" in caplog.text
+
+    clear_slow_lookups()
+    assert slow_lookups() == []
+
+
+def test_slow_lookups_only_uncached(watched):
+    @dispatch("obj", get_key_lookup=DictCachingKeyLookup)
+    def cached(obj):
+        return "default"
+
+    cached(1)
+    cached(1)
+    # the cached component is the first of the cached matches
+    assert [e.method for e in slow_lookups()] == ["all", "fallback"]
+
+
+@pytest.mark.parametrize(
+    "value, threshold", [("", 0), ("1000", 1000), ("1ms", 0), ("-1", 0)]
+)
+def test_slow_lookup_threshold_from_environ(monkeypatch, value, threshold):
+    monkeypatch.setattr("reg.instrument._slow_lookup_threshold", None)
+    monkeypatch.setenv("REG_SLOW_LOOKUP_NS", value)
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        assert slow_lookup_threshold() == threshold
+        assert slow_lookup_threshold() == threshold
+    assert len(caught) == (value in ("1ms", "-1"))
+
+
+def test_slow_lookups_threshold():
+    enable_slow_lookups(threshold_ns=10**12)
+    try:
+
+        @dispatch("obj")
+        def fast(obj):
+            return "default"
+
+        fast(1)
+    finally:
+        disable_slow_lookups()
+    assert slow_lookups() == []
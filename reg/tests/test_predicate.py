@@ -1,4 +1,8 @@
+import random
+from itertools import product
+
 from ..predicate import (
+    INTERN_SIZE,
     KeyIndex,
     ClassIndex,
     PredicateRegistry,
@@ -9,6 +13,56 @@ from ..error import RegistrationError
 import pytest
 
 
+def fallback_by_permutations(registry, keys):
+    # how fallback worked before indexes remembered their first match
+    result = None
+    for index, key in zip(registry.indexes, keys):
+        for k in index.permutations(key):
+            match = index[k]
+            if match:
+                break
+        else:
+            return index.fallback
+        if result is None:
+            result = set(match)
+        else:
+            result = result.intersection(match)
+        if not result:
+            return index.fallback
+
+
+def component_by_permutations(registry, keys):
+    # the values the component can be, as all found them before: those
+    # of the first permutation that has any, preferring an exact match
+    for p in product(
+        *[i.permutations(k) for i, k in zip(registry.indexes, keys)]
+    ):
+        values = set(registry.known_values)
+        for index, key in zip(registry.indexes, p):
+            values.intersection_update(index[key])
+        if values:
+            if p in registry.exact:
+                return {registry.exact[p]}
+            return values
+    return {None}
+
+
+def random_hierarchies(rng, count=3, size=6):
+    # class hierarchies of a few classes, with multiple inheritance
+    hierarchies = []
+    for _ in range(count):
+        classes = [object]
+        for i in range(size):
+            bases = tuple(rng.sample(classes, min(len(classes), 2)))
+            try:
+                classes.append(type("C%s" % i, bases, {}))
+            except TypeError:
+                # no consistent method resolution order
+                classes.append(type("C%s" % i, (rng.choice(classes),), {}))
+        hierarchies.append(classes)
+    return hierarchies
+
+
 def test_key_index_permutations():
     i = KeyIndex()
     assert list(i.permutations("GET")) == ["GET"]
@@ -29,6 +83,8 @@ def test_class_index_permutations():
     assert list(i.permutations(Foo)) == [Foo, object]
     assert list(i.permutations(Bar)) == [Bar, Foo, object]
     assert list(i.permutations(Qux)) == [Qux, object]
+    # the tuple is computed once by Python and shared by all lookups
+    assert i.permutations(Bar) is i.permutations(Bar)
 
 
 def test_multi_class_predicate_permutations():
@@ -392,3 +448,297 @@ def test_nameless_predicate_key():
     p = match_key("a")
 
     assert p.key_by_predicate_name({}) is None
+
+
+def test_registry_exact_key():
+    r = PredicateRegistry(match_instance("a"), match_key("b"))
+
+    class Foo(object):
+        pass
+
+    class FooSub(Foo):
+        pass
+
+    r.register((Foo, "B"), "foo")
+    r.register((FooSub, "B"), "sub")
+
+    assert r.exact == {(Foo, "B"): "foo", (FooSub, "B"): "sub"}
+    assert r.component((Foo, "B")) == "foo"
+    assert r.component((FooSub, "B")) == "sub"
+    assert r.component((FooSub, "C")) is None
+
+
+def test_registry_candidates():
+    class A(object):
+        pass
+
+    class AA(A):
+        pass
+
+    class B(object):
+        pass
+
+    class BB(B):
+        pass
+
+    r = PredicateRegistry(match_instance("a"), match_instance("b"))
+    r.register((A, BB), "a bb")
+    r.register((object, B), "object b")
+
+    assert list(r.candidates((AA, BB))) == [
+        (A, BB),
+        (A, B),
+        (object, BB),
+        (object, B),
+    ]
+    assert list(r.candidates((AA, int))) == []
+    assert list(r.all((AA, BB))) == ["a bb", "object b"]
+
+
+def test_registry_component_randomized():
+    rng = random.Random(43)
+    for _ in range(50):
+        hierarchies = random_hierarchies(rng)
+        r = PredicateRegistry(
+            match_instance("a"), match_instance("b"), match_instance("c")
+        )
+        for i in range(rng.randint(0, 12)):
+            key = tuple(rng.choice(classes) for classes in hierarchies)
+            if key not in r.known_keys:
+                # some values are registered for several keys
+                r.register(key, "value %s" % rng.randint(0, i))
+        for _ in range(20):
+            key = tuple(rng.choice(classes) for classes in hierarchies)
+            assert r.component(key) in component_by_permutations(r, key)
+
+
+def test_class_index_first_match():
+    class A(object):
+        pass
+
+    class B(A):
+        pass
+
+    i = ClassIndex()
+    assert i.first_match(B) is None
+    i.add(object, "object")
+    assert i.first_match(B) == ("object",)
+    i.add(A, "a")
+    assert i.first_match(B) == ("a",)
+    i.add(A, "a")
+    assert i.first_match(B) == ("a",)
+    i.add(A, "other a")
+    assert i.first_match(B) == {"a", "other a"}
+    i.add(A, "another a")
+    assert i.first_match(B) == {"a", "other a", "another a"}
+    assert i.first_match(object) == ("object",)
+
+
+def test_key_index_first_matches_bounded(monkeypatch):
+    monkeypatch.setattr("reg.predicate.FIRST_MATCH_CACHE_SIZE", 2)
+    i = KeyIndex()
+    i.add("a", "value")
+    assert i.first_match("a") == ("value",)
+    assert i.first_match("b") is None
+    assert i.first_match("a") == ("value",)
+    assert i.first_match("c") is None
+    # the oldest is evicted, not everything
+    assert list(i.first_matches) == ["b", "c"]
+
+
+def test_class_index_first_matches_updated():
+    class A(object):
+        pass
+
+    class B(A):
+        pass
+
+    class C(object):
+        pass
+
+    i = ClassIndex()
+    i.add(object, "object")
+    assert i.first_match(B) == ("object",)
+    assert i.first_match(C) == ("object",)
+    assert i.first_match(int) == ("object",)
+
+    # registering updates the keys it matches first, and only those
+    i.add(A, "a")
+    assert {k: match for k, (match, values) in i.first_matches.items()} == {
+        B: A,
+        C: object,
+        int: object,
+    }
+    assert i.first_match(B) == ("a",)
+    i.add(B, "b")
+    i.add(C, "c")
+    i.add(object, "other object")
+    assert i.first_matches == {
+        B: (B, ("b",)),
+        C: (C, ("c",)),
+        int: (object, {"object", "other object"}),
+    }
+    # values added for a key that has some already are found too
+    i.add(B, "other b")
+    assert i.first_match(B) == {"b", "other b"}
+
+    j = KeyIndex()
+    assert j.first_match("a") is None
+    j.add("a", "value")
+    assert j.first_match("a") == ("value",)
+
+
+def test_registry_fallback_randomized():
+    rng = random.Random(45)
+    for _ in range(50):
+        hierarchies = random_hierarchies(rng)
+        r = PredicateRegistry(
+            match_instance("a", fallback="a"),
+            match_instance("b", fallback="b"),
+            match_instance("c", fallback="c"),
+        )
+        for i in range(rng.randint(0, 12)):
+            # look up in between, so that remembered matches go stale
+            for _ in range(5):
+                key = tuple(rng.choice(classes) for classes in hierarchies)
+                assert r.fallback(key) == fallback_by_permutations(r, key)
+            key = tuple(rng.choice(classes) for classes in hierarchies)
+            if key not in r.known_keys:
+                r.register(key, "value %s" % i)
+
+
+def test_registry_get_single_values():
+    r = PredicateRegistry(match_key("a"), match_key("b"))
+    r.register(("x", "y"), "v")
+    r.register(("x", "z"), "w")
+    r.register(("u", "y"), "v")
+
+    assert r.indexes[0]["x"] == {"v", "w"}
+    assert r.indexes[1]["y"] == ("v",)
+    assert set(r.get(("x", "y"))) == {"v"}
+    assert set(r.get(("x", "z"))) == {"w"}
+    assert set(r.get(("u", "z"))) == set()
+    assert set(r.get(("x", "nothing"))) == set()
+
+
+def test_registry_interned_values():
+    r = PredicateRegistry(match_key("a"), match_key("b"))
+    r.register(("x", "y"), "v")
+    r.register(("u", "z"), "v")
+    a, b = r.indexes
+
+    r.register(("x", "z"), "w")
+    assert a["x"] == {"v", "w"}
+    assert a["u"] == ("v",)
+    assert b["y"] == ("v",)
+
+    # keys with the same values share them, across indexes too
+    r.register(("u", "y"), "w")
+    assert a["u"] is a["x"] is b["y"] is b["z"]
+    assert set(r.get(("x", "y"))) == {"v", "w"}
+
+    # keys with many values get a set of their own
+    for i in range(INTERN_SIZE):
+        r.register(("many", i), "value %s" % i)
+    assert type(a["many"]) is frozenset
+    r.register(("many", INTERN_SIZE), "value %s" % INTERN_SIZE)
+    r.register(("lots", 0), "value 0")
+    assert type(a["many"]) is set
+    assert a["many"] == {"value %s" % i for i in range(INTERN_SIZE + 1)}
+    r.register(("many", "v"), "v")
+    assert len(a["many"]) == INTERN_SIZE + 2
+    assert a["lots"] == ("value 0",)
+
+
+def test_registry_register_all():
+    registrations = [(("x", i), "v") for i in range(3)]
+    registrations += [(("y", i), "w%s" % i) for i in range(INTERN_SIZE + 1)]
+    registrations += [(("z", i), "u%s" % i) for i in range(2)]
+    registrations += [(("z", 5), "v")]
+
+    one_by_one = PredicateRegistry(match_key("a"), match_key("b"))
+    one_by_one.register(("x", "first"), "v")
+    for key, value in registrations:
+        one_by_one.register(key, value)
+
+    r = PredicateRegistry(match_key("a"), match_key("b"))
+    r.register(("x", "first"), "v")
+    notified = []
+    r.listeners.append(lambda: notified.append(r.generation))
+    r.register_all(registrations)
+    assert notified == [2]
+
+    for index, expected in zip(r.indexes, one_by_one.indexes):
+        assert index == expected
+        assert {k: type(v) for k, v in index.items()} == {
+            k: type(v) for k, v in expected.items()
+        }
+    assert r.interned == one_by_one.interned
+    assert r.known_keys == one_by_one.known_keys
+    assert r.known_values == one_by_one.known_values
+    assert r.exact == one_by_one.exact
+
+    with pytest.raises(RegistrationError):
+        r.register_all([(("new", 0), "n"), (("x", 0), "n")])
+    with pytest.raises(RegistrationError):
+        r.register_all([(("new", 0), "n"), (("new", 0), "m")])
+    assert ("new", 0) not in r.known_keys
+    assert r.register_all([]) is None
+    assert notified == [2]
+
+
+def test_registry_interned_values_released():
+    r = PredicateRegistry(match_key("a"), match_key("b"))
+    r.register(("x", 1), "v")
+    r.register(("x", 2), "w")
+    r.register(("y", 1), "v")
+    r.register(("y", 2), "w")
+    a, b = r.indexes
+    assert list(r.interned) == [frozenset(["v", "w"])]
+
+    # replaced values are dropped once no key uses them
+    r.register(("x", 3), "u")
+    assert set(r.interned) == {
+        frozenset(["v", "w"]),
+        frozenset(["u", "v", "w"]),
+    }
+    r.register(("y", 3), "u")
+    assert list(r.interned) == [frozenset(["u", "v", "w"])]
+
+    # and so are those replaced by a set of their own
+    for i in range(INTERN_SIZE):
+        r.register(("x", "x%s" % i), "x%s" % i)
+        r.register(("y", "y%s" % i), "y%s" % i)
+    assert type(a["x"]) is type(a["y"]) is set
+    assert r.interned == {}
+
+
+def test_registry_all_shared_values():
+    class A(object):
+        pass
+
+    class B(object):
+        pass
+
+    class ASub(A):
+        pass
+
+    r = PredicateRegistry(
+        match_instance("obj", fallback="obj fallback"), match_key("name")
+    )
+    r.register((A, "edit"), "shared")
+    r.register((B, "view"), "shared")
+
+    # the values for A and for "view" have "shared" in common, so it
+    # matches, even though it isn't registered for both
+    assert list(r.all((A, "view"))) == ["shared"]
+    assert r.component((A, "view")) == "shared"
+    assert r.component((ASub, "view")) == "shared"
+    assert r.fallback((ASub, "view")) is None
+
+    # the value registered for a key comes first
+    r.register((A, "view"), "a view")
+    assert list(r.all((A, "view"))) == ["a view", "shared"]
+    assert list(r.all((ASub, "view"))) == ["a view", "shared"]
+    assert r.component((ASub, "view")) == "a view"
+    assert list(r.all((ASub, "edit"))) == ["shared"]
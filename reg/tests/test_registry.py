@@ -1,8 +1,14 @@
 from __future__ import unicode_literals
 from ..predicate import PredicateRegistry, match_instance, match_key
-from ..cache import DictCachingKeyLookup, LruCachingKeyLookup
+from ..cache import (
+    DictCachingKeyLookup,
+    LruCachingKeyLookup,
+    AdaptiveCachingKeyLookup,
+    GenerationalCache,
+    key_lookup_from_spec,
+)
 from ..error import RegistrationError
-from ..dispatch import dispatch
+from ..dispatch import dispatch, set_default_key_lookup
 import pytest
 
 
@@ -379,3 +385,232 @@ def test_lru_caching_registry():
     assert view(Foo(), Request("dummy", "GET")) == "Name fallback"
     assert view(Foo(), Request("", "PUT")) == "Request method fallback"
     assert view(FooSub(), Request("dummy", "GET")) == "Name fallback"
+
+
+@pytest.mark.parametrize(
+    "spec", ["dict", "lru:10", "lru", "2q:10", "arc", "adaptive:10"]
+)
+def test_caching_registry_register_after_call(spec):
+    @dispatch("obj", get_key_lookup=key_lookup_from_spec(spec))
+    def foo(obj):
+        return "default"
+
+    key_lookup = foo.key_lookup
+    assert foo(1) == "default"
+    assert foo.by_args(1).fallback is None
+
+    foo.register(lambda obj: "int", obj=int)
+
+    # the caches are emptied, but the key lookup is kept
+    assert foo.key_lookup is key_lookup
+    assert foo(1) == "int"
+    assert foo.by_args(1).component is not None
+
+
+def test_custom_key_lookup_register_after_call():
+    class KeyLookup(object):
+        def __init__(self, registry):
+            self.registry = registry
+            self.component = registry.component
+            self.fallback = registry.fallback
+            self.all = registry.all
+
+    @dispatch("obj", get_key_lookup=KeyLookup)
+    def foo(obj):
+        return "default"
+
+    key_lookup = foo.key_lookup
+    assert foo(1) == "default"
+    foo.register(lambda obj: "int", obj=int)
+
+    assert foo.key_lookup is key_lookup
+    assert foo(1) == "int"
+
+
+def test_key_lookup_from_spec():
+    r = PredicateRegistry(match_key("a"))
+
+    assert key_lookup_from_spec("") is None
+    assert key_lookup_from_spec("identity") is None
+    assert isinstance(key_lookup_from_spec("dict")(r), DictCachingKeyLookup)
+    lookup = key_lookup_from_spec("lru:10")(r)
+    assert isinstance(lookup, LruCachingKeyLookup)
+    assert lookup.component._cache.size == 10
+
+    lookup = key_lookup_from_spec("adaptive")(r)
+    assert isinstance(lookup, AdaptiveCachingKeyLookup)
+    assert lookup.component.__self__.size == 5000
+    lookup = key_lookup_from_spec("adaptive:10")(r)
+    assert lookup.component.__self__.size == 10
+
+    with pytest.raises(ValueError):
+        key_lookup_from_spec("lru:many")
+    with pytest.raises(ValueError):
+        key_lookup_from_spec("unknown")
+
+
+def test_set_default_key_lookup():
+    @dispatch("obj")
+    def before(obj):
+        return "default"
+
+    @dispatch("obj", get_key_lookup=key_lookup_from_spec("lru:10"))
+    def explicit(obj):
+        return "default"
+
+    explicit_lookup = explicit.key_lookup
+
+    before.register(lambda obj: "int", obj=int)
+    try:
+        set_default_key_lookup("dict")
+
+        @dispatch("obj")
+        def after(obj):
+            return "default"
+
+        assert isinstance(before.key_lookup, DictCachingKeyLookup)
+        assert isinstance(after.key_lookup, DictCachingKeyLookup)
+        assert explicit.key_lookup is explicit_lookup
+        assert before(1) == "int"
+        assert before("a") == "default"
+    finally:
+        set_default_key_lookup(None)
+
+    assert isinstance(before.key_lookup, PredicateRegistry)
+    assert isinstance(after.key_lookup, PredicateRegistry)
+    assert before(1) == "int"
+
+
+def test_generational_cache():
+    computed = []
+
+    def func(key):
+        computed.append(key)
+        return key * 2
+
+    cache = GenerationalCache(func, 3)
+    assert [cache[i] for i in (1, 2)] == [2, 4]
+    assert dict(cache) == {1: 2, 2: 4}
+    assert not cache.bounded
+
+    # the cache is full, so it starts keeping generations
+    assert cache[3] == 6
+    assert cache.bounded
+    assert cache[4] == 8
+    assert cache.young == {4: 8}
+    assert sorted(cache.cached_keys()) == [1, 2, 3, 4]
+    assert computed == [1, 2, 3, 4]
+
+    # the entries from before stay until the next generation
+    assert cache[1] == 2
+    assert cache[5] == 10
+    assert cache[6] == 12
+    assert computed == [1, 2, 3, 4, 5, 6]
+
+    # which only swaps references
+    young = cache.young
+    assert cache[7] == 14
+    assert dict(cache) == {}
+    assert cache.old is young
+    assert cache.old == {4: 8, 5: 10, 6: 12}
+    assert cache.young == {7: 14}
+
+    # entries of the old generation are reused
+    assert cache[4] == 8
+    assert computed == [1, 2, 3, 4, 5, 6, 7]
+    assert cache.young == {7: 14, 4: 8}
+    assert cache.old == {5: 10, 6: 12}
+
+    # and the rest is dropped with the next generation
+    assert cache[8] == 16
+    assert cache[9] == 18
+    assert cache.old == {7: 14, 4: 8, 8: 16}
+    assert cache[5] == 10
+    assert computed == [1, 2, 3, 4, 5, 6, 7, 8, 9, 5]
+
+    cache.clear()
+    assert cache.cached_keys() == []
+    assert cache.bounded
+
+
+def test_generational_cache_miss_rate():
+    cache = GenerationalCache(lambda key: key, 100000)
+    hot = list(range(100))
+    for key in hot:
+        cache[key]
+    # keys are sampled to estimate the miss rate
+    assert sorted(cache.sampled) == [15, 31, 47, 63, 79, 95]
+    assert 15 not in dict(cache)
+
+    for i in range(100):
+        for key in hot:
+            cache[key]
+    # few lookups missed, so the sampled keys became plain entries
+    assert not cache.bounded
+    assert cache.sampled == {}
+    assert 15 in dict(cache)
+
+    # a scan through new keys misses every time
+    for key in range(1000, 10000):
+        cache[key]
+        if cache.bounded:
+            break
+    assert cache.bounded
+    assert key < 3000
+    assert len(cache.cached_keys()) < 2 * cache.size
+
+
+def test_adaptive_caching_registry():
+    class Foo(object):
+        pass
+
+    class FooSub(Foo):
+        pass
+
+    @dispatch(
+        "obj",
+        get_key_lookup=lambda r: AdaptiveCachingKeyLookup(r, 2, 2, 2),
+    )
+    def foo(obj):
+        return "default"
+
+    @foo.register(obj=Foo)
+    def foo_foo(obj):
+        return "foo"
+
+    classes = [type("Cls%s" % i, (Foo,), {}) for i in range(10)]
+    for cls in classes:
+        assert foo(cls()) == "foo"
+    assert foo(1) == "default"
+    assert foo.by_args(FooSub()).all_matches == [foo_foo]
+
+    component_cache = foo.key_lookup.component.__self__
+    assert len(component_cache.cached_keys()) <= 4
+    fallback_cache = foo.key_lookup.fallback.__self__
+    assert fallback_cache[(int,)] is None
+
+
+@pytest.mark.parametrize(
+    "get_key_lookup", [None, DictCachingKeyLookup, AdaptiveCachingKeyLookup]
+)
+def test_implementation_registered_for_several_keys(get_key_lookup):
+    class A(object):
+        pass
+
+    class B(object):
+        pass
+
+    @dispatch("obj", match_key("name"), get_key_lookup=get_key_lookup)
+    def view(obj, name):
+        return "default"
+
+    def shared(obj, name):
+        return "shared"
+
+    view.register(shared, obj=A, name="edit")
+    view.register(shared, obj=B, name="view")
+
+    # the registrations for A and for "view" have it in common
+    assert view(A(), "view") == "shared"
+    assert view.by_args(A(), "view").all_matches == [shared]
+    assert view(B(), "edit") == "shared"
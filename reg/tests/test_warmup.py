@@ -0,0 +1,159 @@
+import json
+
+import pytest
+
+from ..cache import (
+    DictCachingKeyLookup,
+    LruCachingKeyLookup,
+    PolicyCachingKeyLookup,
+    AdaptiveCachingKeyLookup,
+)
+from ..dispatch import dispatch
+from ..predicate import match_instance, match_key
+from ..warmup import (
+    key_profile,
+    save_key_profile,
+    load_key_profile,
+    encode_key_part,
+    decode_key_part,
+    _skip,
+)
+
+
+class Document(object):
+    pass
+
+
+class Report(Document):
+    pass
+
+
+caching_key_lookups = [
+    DictCachingKeyLookup,
+    lambda r: LruCachingKeyLookup(r, 100, 100, 100),
+    lambda r: PolicyCachingKeyLookup(r, 100, 100, 100, policy="2q"),
+    lambda r: PolicyCachingKeyLookup(r, 100, 100, 100, policy="arc"),
+    AdaptiveCachingKeyLookup,
+]
+
+
+@pytest.mark.parametrize("get_key_lookup", caching_key_lookups)
+def test_cached_keys(get_key_lookup):
+    @dispatch("obj", get_key_lookup=get_key_lookup)
+    def view(obj):
+        return "default"
+
+    view(Document())
+    view(Report())
+    view(Document())
+
+    assert sorted(
+        view.key_lookup.cached_keys(), key=lambda key: key[0].__name__
+    ) == [(Document,), (Report,)]
+
+
+def test_encode_key_part():
+    assert encode_key_part(Report) == {"class": "reg.tests.test_warmup:Report"}
+    assert encode_key_part("edit") == ["edit"]
+    assert encode_key_part(None) == [None]
+
+    class Local(object):
+        pass
+
+    assert encode_key_part(Local) is None
+    assert encode_key_part(object()) is None
+
+
+def test_decode_key_part():
+    assert decode_key_part({"class": "reg.tests.test_warmup:Report"}) is (
+        Report
+    )
+    assert decode_key_part({"class": "builtins:object"}) is object
+    assert decode_key_part(["edit"]) == "edit"
+    assert decode_key_part({"class": "reg.tests.test_warmup:Nope"}) is _skip
+    assert decode_key_part({"class": "not.imported:Report"}) is _skip
+    assert decode_key_part("garbage") is _skip
+
+
+def test_save_and_load_key_profile(tmp_path):
+    path = str(tmp_path / "profile.json")
+
+    @dispatch(
+        match_instance("obj"),
+        match_key("name"),
+        get_key_lookup=DictCachingKeyLookup,
+    )
+    def view(obj, name):
+        return "default"
+
+    view.register(lambda obj, name: "document", obj=Document, name="edit")
+    assert view(Report(), "edit") == "document"
+    assert view(Document(), "delete") == "default"
+
+    save_key_profile(path)
+    with open(path) as f:
+        data = json.load(f)
+    assert data["version"] == 1
+    name = "reg.tests.test_warmup.test_save_and_load_key_profile.<locals>.view"
+    assert sorted(data["dispatch"][name], key=json.dumps) == [
+        [{"class": "reg.tests.test_warmup:Document"}, ["delete"]],
+        [{"class": "reg.tests.test_warmup:Report"}, ["edit"]],
+    ]
+    assert key_profile()[name] == data["dispatch"][name]
+
+    # a fresh process would only have an empty cache
+    view.register(lambda obj, name: "report", obj=Report, name="edit")
+    assert view.key_lookup.cached_keys() == []
+
+    # stale and unimportable entries are skipped
+    data["dispatch"][name].append([["too short"]])
+    data["dispatch"][name].append(
+        [{"class": "reg.tests.test_warmup:Gone"}, ["edit"]]
+    )
+    data["dispatch"]["no.such.dispatch"] = [[["a"]]]
+    with open(path, "w") as f:
+        json.dump(data, f)
+
+    assert load_key_profile(path) >= 2
+    assert sorted(
+        view.key_lookup.cached_keys(), key=lambda key: key[0].__name__
+    ) == [(Document, "delete"), (Report, "edit")]
+    assert view(Report(), "edit") == "report"
+
+
+def test_load_key_profile_other_version(tmp_path):
+    path = str(tmp_path / "profile.json")
+    with open(path, "w") as f:
+        json.dump({"version": 0, "dispatch": {}}, f)
+
+    assert load_key_profile(path) == 0
+
+
+def test_key_profile_skips_uncached():
+    @dispatch("obj")
+    def view(obj):
+        return "default"
+
+    view(Document())
+
+    name = "reg.tests.test_warmup.test_key_profile_skips_uncached.<locals>.view"
+    assert name not in key_profile()
+
+
+def test_key_profile_shared_name():
+    views = []
+    for i in range(2):
+
+        @dispatch("obj", get_key_lookup=DictCachingKeyLookup)
+        def view(obj):
+            return "default"
+
+        view(Document())
+        views.append(view)
+    views[1](Report())
+
+    name = "reg.tests.test_warmup.test_key_profile_shared_name.<locals>.view"
+    assert sorted(key_profile()[name], key=str) == [
+        [{"class": "reg.tests.test_warmup:Document"}],
+        [{"class": "reg.tests.test_warmup:Report"}],
+    ]
@@ -0,0 +1,139 @@
+"""Persist the keys seen by caching key lookups and preload them.
+
+A process starts off with empty caches, so its first calls of each
+dispatch function go through the :class:`reg.PredicateRegistry`. To
+avoid this, save the key profile of a warmed up process with
+:func:`save_key_profile` and load it into a fresh process with
+:func:`load_key_profile`, once its implementations are registered.
+
+Classes in keys are referenced by module and qualified name. Keys that
+can't be represented this way, such as keys with classes defined in a
+function, aren't saved.
+"""
+
+import json
+import sys
+
+from .dispatch import _dispatches, dotted_name
+
+VERSION = 1
+
+_skip = object()
+
+
+def encode_key_part(part):
+    """Encode part of a predicate key as JSON data.
+
+    :returns: the JSON data, or ``None`` if the part can't be encoded.
+    """
+    if isinstance(part, type):
+        qualname = part.__qualname__
+        if "<locals>" in qualname:
+            return None
+        return {"class": "{}:{}".format(part.__module__, qualname)}
+    if part is None or isinstance(part, (str, int, float)):
+        return [part]
+    return None
+
+
+def decode_key_part(data):
+    """Decode part of a predicate key encoded by :func:`encode_key_part`.
+
+    Classes are only looked up in modules that are already imported.
+
+    :returns: the part of the key, or ``_skip`` if it can't be decoded.
+    """
+    if isinstance(data, list) and len(data) == 1:
+        return data[0]
+    if not isinstance(data, dict):
+        return _skip
+    obj = resolve(str(data.get("class")))
+    if not isinstance(obj, type):
+        return _skip
+    return obj
+
+
+def resolve(reference):
+    """Look up an object referenced as ``module:qualname``.
+
+    :returns: the object, or ``None`` if its module isn't imported or
+      doesn't have it.
+    """
+    module_name, _, qualname = reference.partition(":")
+    obj = sys.modules.get(module_name)
+    for name in qualname.split("."):
+        obj = getattr(obj, name, None)
+    return obj
+
+
+def key_profile():
+    """The keys cached by the caching key lookups of dispatch functions.
+
+    Dispatch functions that don't use a caching key lookup with a
+    ``cached_keys`` method aren't included.
+
+    :returns: a dictionary mapping the dotted names of the dispatch
+      functions to lists of encoded predicate keys.
+    """
+    result = {}
+    # the keys already encoded for each name, as dispatch functions
+    # can share a name
+    seen = {}
+    for d in list(_dispatches):
+        cached_keys = getattr(d.key_lookup, "cached_keys", None)
+        if cached_keys is None:
+            continue
+        name = dotted_name(d.wrapped_func)
+        keys = result.setdefault(name, [])
+        known = seen.setdefault(name, set())
+        for key in cached_keys():
+            if key in known:
+                continue
+            known.add(key)
+            encoded = [encode_key_part(part) for part in key]
+            if None not in encoded:
+                keys.append(encoded)
+    return {name: keys for name, keys in result.items() if keys}
+
+
+def save_key_profile(path):
+    """Save the :func:`key_profile` of this process to a JSON file.
+
+    :param path: the path of the file to write.
+    """
+    with open(path, "w") as f:
+        json.dump({"version": VERSION, "dispatch": key_profile()}, f)
+
+
+def load_key_profile(path):
+    """Preload the caches of dispatch functions from a JSON file.
+
+    Keys of dispatch functions that don't exist or don't use a
+    caching key lookup, keys with the wrong number of predicates, and
+    keys that reference classes that aren't imported are skipped. A
+    file with another version is ignored altogether.
+
+    :param path: the path of a file written by :func:`save_key_profile`.
+    :returns: the number of keys looked up.
+    """
+    with open(path) as f:
+        data = json.load(f)
+    if data.get("version") != VERSION:
+        return 0
+    profile = data.get("dispatch", {})
+    count = 0
+    for d in list(_dispatches):
+        if not hasattr(d.key_lookup, "cached_keys"):
+            continue
+        encoded_keys = profile.get(dotted_name(d.wrapped_func), ())
+        size = len(d.predicates)
+        for encoded in encoded_keys:
+            if len(encoded) != size:
+                continue
+            key = tuple(decode_key_part(part) for part in encoded)
+            if any(part is _skip for part in key):
+                continue
+            if d.key_lookup.component(key) is None:
+                d.key_lookup.fallback(key)
+            count += 1
+    return count